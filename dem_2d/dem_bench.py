@@ -0,0 +1,238 @@
+"""benchmark the minidem engine on reproducible scenes of growing size.
+
+Each case builds a seeded scene, runs a few warm-up iterations of
+minidem.time_step and then times the next ones with minidem.profiler, so
+that the time of each phase, the number of iterations per second and the
+counters are known. The cases run one by one in fresh processes, which
+gives a meaningful peak memory (max RSS) for each of them. The scenes are :
+ - dilute : grains at a packing fraction of 0.1 with random velocities
+ - dense  : a packed lattice of grains that settles under gravity
+ - bonded : the dense lattice with a bond between the lattice neighbours
+ - a domain file (xyzr text or .dem, see minidem.save_domain) given with
+   --domain, in a box fitted around it
+
+The results are saved in a json file with the git commit, so that runs on
+different commits can be compared :
+
+    python dem_bench.py -o before.json
+    python dem_bench.py -o after.json --compare before.json
+    python dem_bench.py --sizes 400 102400 --scenes dense --steps 50
+    python dem_bench.py --domain compact-domain.txt --scenes"""
+
+import argparse
+import datetime
+import json
+import math
+import multiprocessing as mp
+import os
+import platform
+import subprocess
+import sys
+
+import numpy as np
+
+import minidem as dem
+
+SIZES  = (400, 1600, 6400, 25600, 102400)
+SCENES = ("dilute", "dense", "bonded")
+
+
+def _lattice(n, spacing):
+    """returns the positions of n grains on a square lattice of about
+sqrt(n) columns and its number of columns"""
+    cols = math.ceil(math.sqrt(n))
+    k = np.arange(n)
+    pos = np.stack((k % cols, k // cols), axis=1)*spacing + spacing
+    return pos.astype(float), cols
+
+
+def make_scene(scene, n, seed=0):
+    """fill a new minidem.simu with the scene of n grains and returns the
+parameters of minidem.time_step for this scene, box included"""
+    rng = np.random.default_rng(seed)
+    dem.simu = dem.Simulation()
+    grains = dem.simu.grains
+    radius = rng.uniform(0.8, 1., n)
+    params = {}
+    if scene == "dilute":
+        spacing = math.sqrt(math.pi/0.1)
+        pos, cols = _lattice(n, spacing)
+        pos += rng.uniform(-0.3, 0.3, (n, 2))*(spacing - 2.)
+        grains.extend(pos, radius, 1., rng.normal(0., 5., (n, 2)))
+        params["gravity"] = 0.
+    elif scene in ("dense", "bonded"):
+        spacing = 2.02
+        pos, cols = _lattice(n, spacing)
+        pos += rng.uniform(-0.01, 0.01, (n, 2))
+        grains.extend(pos, radius, 1.)
+        if scene == "bonded":
+            k = np.arange(n)
+            right = (k % cols < cols - 1) & (k + 1 < n)
+            up    = k + cols < n
+            i = np.concatenate((k[right], k[up]))
+            j = np.concatenate((k[right] + 1, k[up] + cols))
+            dem.simu.bonds.extend(i, j, grains)
+            dem.simu.bond_list.extend_lazy(len(i))
+            params["exclude_bonded_grain"] = True
+    else:
+        raise ValueError("unknown scene '{}'".format(scene))
+    dem.simu.grain_list.extend_lazy(n)
+    params["xlim"] = params["ylim"] = (0., (cols + 1)*spacing)
+    return params
+
+
+def load_scene(filename):
+    """fill a new minidem.simu with the domain file and returns the
+parameters of minidem.time_step, the box is fitted around the grains"""
+    dem.simu = dem.Simulation()
+    dem.load_domain(filename)
+    grains = dem.simu.grains
+    r = grains.radius.max()
+    lo, hi = grains.pos.min(axis=0) - r, grains.pos.max(axis=0) + r
+    return {"xlim" : (lo[0], hi[0]), "ylim" : (lo[1], hi[1])}
+
+
+def _peak_memory():
+    """returns the peak resident memory of the process in MB, or None if it
+is not available (windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes on linux
+    return rss/2**20 if sys.platform == "darwin" else rss/2**10
+
+
+def run_case(scene, n, steps, warmup, dt, seed):
+    """run one case and returns its results as a dict"""
+    if scene.startswith("file:"):
+        params = load_scene(scene[5:])
+    else:
+        params = make_scene(scene, n, seed)
+    sim = dem.simu
+    n_bond = sim.bonds.n
+    for k in range(warmup):
+        dem.time_step(dt, **params)
+    sim.loop_function = lambda: dem.time_step(dt, **params)
+    sim.profile.enabled = True
+    sim.profile.reset()
+    sim.step(steps)
+    profile = sim.profile.snapshot()
+    wall = profile["wall_time"]
+    return {"scene"           : scene,
+            "grains"          : sim.grains.n,
+            "bonds"           : n_bond,
+            "steps"           : steps,
+            "dt"              : dt,
+            "seed"            : seed,
+            "wall_time"       : wall,
+            "steps_per_second": steps/wall if wall else None,
+            "ms_per_step"     : 1e3*wall/steps if steps else None,
+            "peak_memory_mb"  : _peak_memory(),
+            "profile"         : profile}
+
+
+def _run_case(args):
+    return run_case(*args)
+
+
+def git_revision():
+    """returns the commit of the source tree and if it has local changes"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=here, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty  = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no", "."], cwd=here,
+                                capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def benchmark(cases, steps=100, warmup=10, dt=5e-4, seed=0, verbose=True):
+    """run the cases, a list of (scene, n), each one in a fresh process and
+returns the results with the description of the machine and the commit"""
+    commit, dirty = git_revision()
+    results = {"date"     : datetime.datetime.now().isoformat(timespec="seconds"),
+               "commit"   : commit,
+               "dirty"    : dirty,
+               "python"   : platform.python_version(),
+               "numpy"    : np.__version__,
+               "platform" : platform.platform(),
+               "cpu_count": os.cpu_count(),
+               "cases"    : []}
+    if verbose:
+        print(_header())
+    context = mp.get_context("spawn")
+    for scene, n in cases:
+        with context.Pool(1) as pool:
+            case = pool.apply(_run_case, ((scene, n, steps, warmup, dt, seed),))
+        results["cases"].append(case)
+        if verbose:
+            print(_row(case))
+    return results
+
+
+def _label(scene):
+    return "file " + os.path.basename(scene[5:]) if scene.startswith("file:") else scene
+
+
+def _header():
+    return "{:<24}{:>9}{:>9}{:>10}{:>11}{:>10}  {}".format(
+        "scene", "grains", "bonds", "steps/s", "ms/step", "peak MB", "main phases")
+
+
+def _row(case):
+    times = case["profile"]["times"]
+    wall  = case["wall_time"] or 1.
+    main  = sorted(times.items(), key=lambda item: item[1], reverse=True)[:3]
+    peak  = case["peak_memory_mb"]
+    return "{:<24}{:>9}{:>9}{:>10.1f}{:>11.3f}{:>10}  {}".format(
+        _label(case["scene"])[:24], case["grains"], case["bonds"], case["steps_per_second"], case["ms_per_step"],
+        "{:.0f}".format(peak) if peak is not None else "-",
+        ", ".join("{} {:.0f}%".format(name, 100*t/wall) for name, t in main))
+
+
+def compare(results, reference):
+    """print the speedup of results over the reference results for the
+cases that are in both"""
+    ref = {(c["scene"], c["grains"]): c for c in reference["cases"]}
+    print("compared with commit {} ({})".format((reference.get("commit") or "?")[:10], reference.get("date")))
+    print("{:<24}{:>9}{:>12}{:>12}{:>10}{:>10}".format("scene", "grains", "ref ms", "ms/step", "speedup", "memory"))
+    for case in results["cases"]:
+        old = ref.get((case["scene"], case["grains"]))
+        if old is None:
+            continue
+        memory = "-"
+        if case["peak_memory_mb"] and old["peak_memory_mb"]:
+            memory = "{:+.0f}%".format(100*(case["peak_memory_mb"]/old["peak_memory_mb"] - 1))
+        print("{:<24}{:>9}{:>12.3f}{:>12.3f}{:>9.2f}x{:>10}".format(
+            _label(case["scene"])[:24], case["grains"], old["ms_per_step"], case["ms_per_step"],
+            old["ms_per_step"]/case["ms_per_step"], memory))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="*", default=SIZES, help="the numbers of grains")
+    parser.add_argument("--scenes", nargs="*", default=SCENES, choices=SCENES)
+    parser.add_argument("--domain", action="append", default=[], help="a domain file to benchmark too")
+    parser.add_argument("--steps", type=int, default=100, help="the number of timed iterations")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--dt", type=float, default=5e-4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="the json file of the results")
+    parser.add_argument("--compare", help="a json file of previous results")
+    args = parser.parse_args()
+
+    cases  = [(scene, n) for scene in args.scenes for n in args.sizes]
+    cases += [("file:" + filename, None) for filename in args.domain]
+    results = benchmark(cases, steps=args.steps, warmup=args.warmup, dt=args.dt, seed=args.seed)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+        print("saving '{}'".format(args.output))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
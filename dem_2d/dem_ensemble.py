@@ -0,0 +1,192 @@
+"""run an ensemble of minidem simulations over a grid of parameters.
+
+Each case is the scene of dem_sim.py (grains on a regular grid with random
+offsets and radii that settle in a box under gravity) run headless with
+minidem.time_step. The cases are the cartesian product of the values given
+for each parameter, they are computed in a process pool, each one in its
+own minidem.Simulation, and their summary statistics are collected in one
+csv table. The final domain of each case can be saved in a .dem file (see
+minidem.save_domain).
+
+    python dem_ensemble.py --stiffness 5e4 1e5 2e5 --seed 0 1 2 -o sweep.csv
+    python dem_ensemble.py --restitution-coef 0.1 0.5 0.9 --radius-spread 0 1 --snapshots sweep
+    python dem_ensemble.py --seeds 32 --steps 4000 --sleep -j 8"""
+
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import math
+import os
+import time
+
+import numpy as np
+
+import minidem as dem
+
+# the parameters of a case and their default values, the ones of dem_sim.py
+PARAMS = {"stiffness"        : 1e5,
+          "restitution_coef" : 0.5,
+          "radius"           : 1.5,
+          "radius_spread"    : 1.,
+          "density"          : 1.,
+          "spacing"          : 5.,
+          "gravity"          : -9.81,
+          "seed"             : 0}
+
+STATISTICS = ("t", "grains", "wall_time", "mean_height", "top", "packing_fraction", "kinetic_energy",
+              "max_speed", "contacts", "coordination", "max_overlap", "asleep")
+
+
+def expand(grid):
+    """returns the list of the cases of grid, a dict that gives the list of
+the values of some parameters, the other ones have their default value"""
+    unknown = set(grid) - set(PARAMS)
+    if unknown:
+        raise ValueError("unknown parameters {}".format(", ".join(sorted(unknown))))
+    names = list(grid)
+    cases = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        case = dict(PARAMS)
+        case.update(zip(names, values))
+        cases.append(case)
+    return cases
+
+
+def make_scene(sim, case, xlim=(0,100), ylim=(0,100)):
+    """fill sim with the grains of dem_sim.py : one grain per node of a grid
+of the given spacing, with a random offset in [0,1) and a radius in
+[radius, radius + radius_spread)"""
+    rng = np.random.default_rng(case["seed"])
+    x = np.arange(xlim[0] + 2., xlim[1] - 1., case["spacing"])
+    y = np.arange(ylim[0] + 2., ylim[1] - 1., case["spacing"])
+    pos = np.stack(np.meshgrid(x, y, indexing="ij"), axis=-1).reshape(-1, 2)
+    pos += rng.random(pos.shape)
+    radius = case["radius"] + case["radius_spread"]*rng.random(len(pos))
+    sim.grains.extend(pos, radius, case["density"])
+    sim.grain_list.extend_lazy(len(pos))
+
+
+def statistics(sim, xlim=(0,100)):
+    """returns the summary statistics of the state of sim"""
+    grains = sim.grains
+    pos, vel, radius = grains.pos, grains.vel, grains.radius
+    speed2 = vel[:,0]**2 + vel[:,1]**2
+    top = (pos[:,1] + radius).max()
+    # the lcm skips the pairs of two sleeping grains, they are all counted here
+    asleep = grains.asleep.copy()
+    grains.asleep[:] = False
+    with sim:
+        i, j = dem.lcm.compute_pair_index()
+    grains.asleep[:] = asleep
+    rel_pos = pos[j] - pos[i]
+    contacts = np.count_nonzero(rel_pos[:,0]**2 + rel_pos[:,1]**2 < (radius[i] + radius[j])**2)
+    return {"t"                : sim.t,
+            "grains"           : grains.n,
+            "mean_height"      : pos[:,1].mean(),
+            "top"              : top,
+            "packing_fraction" : math.pi*(radius**2).sum()/((xlim[1] - xlim[0])*top),
+            "kinetic_energy"   : 0.5*(grains.mass*speed2).sum(),
+            "max_speed"        : math.sqrt(speed2.max()),
+            "contacts"         : contacts,
+            "coordination"     : 2*contacts/grains.n,
+            "max_overlap"      : sim.max_overlap,
+            "asleep"           : int(asleep.sum())}
+
+
+def run_case(case, steps=2000, dt=0.005, sleep=False, snapshot=None):
+    """run one case in a new simulation and returns the case with its
+statistics, the final domain is saved in the file snapshot if it is given"""
+    xlim = ylim = (0,100)
+    sim = dem.Simulation(xlim, ylim)
+    sim.dt = dt
+    if sleep:
+        with sim:
+            sim.sleep = dem.sleep_control()
+    make_scene(sim, case, xlim, ylim)
+    start = time.perf_counter()
+    sim.run_headless(steps, lambda: dem.time_step(dt, gravity=case["gravity"], stiffness=case["stiffness"],
+                                                  restitution_coef=case["restitution_coef"], xlim=xlim, ylim=ylim))
+    wall = time.perf_counter() - start
+    result = dict(case)
+    result.update(statistics(sim, xlim))
+    result["wall_time"] = wall
+    if snapshot is not None:
+        with sim:
+            dem.save_domain(snapshot)
+        result["snapshot"] = snapshot
+    return result
+
+
+def run_ensemble(cases, steps=2000, dt=0.005, sleep=False, workers=None, snapshot_dir=None, verbose=True):
+    """run the cases in a pool of workers processes and returns their results
+in the order of the cases. With one worker, the cases run one after the
+other in this process."""
+    snapshots = [None]*len(cases)
+    if snapshot_dir is not None:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        snapshots = [os.path.join(snapshot_dir, "case_{:04d}.dem".format(k)) for k in range(len(cases))]
+    results = [None]*len(cases)
+    if verbose:
+        print(_header())
+    if workers == 1:
+        for k, case in enumerate(cases):
+            results[k] = run_case(case, steps, dt, sleep, snapshots[k])
+            if verbose:
+                print(_row(k, results[k]))
+        return results
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_case, case, steps, dt, sleep, snapshots[k]): k for k, case in enumerate(cases)}
+        for future in concurrent.futures.as_completed(futures):
+            k = futures[future]
+            results[k] = future.result()
+            if verbose:
+                print(_row(k, results[k]))
+    return results
+
+
+def write_results(filename, results):
+    """write the results in a csv file, one row per case"""
+    columns = ["case"] + list(PARAMS) + list(STATISTICS)
+    if any("snapshot" in r for r in results):
+        columns.append("snapshot")
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, columns, extrasaction="ignore")
+        writer.writeheader()
+        for k, result in enumerate(results):
+            writer.writerow(dict(result, case=k))
+    print("saving '{}'".format(filename))
+
+
+def _header():
+    return "{:>5}{:>11}{:>8}{:>8}{:>6}{:>10}{:>9}{:>9}{:>11}{:>7}".format(
+        "case", "stiffness", "rest.", "radius", "seed", "height", "packing", "coord.", "kinetic", "time")
+
+
+def _row(k, r):
+    return "{:>5}{:>11.3g}{:>8.3g}{:>8.3g}{:>6}{:>10.3f}{:>9.3f}{:>9.2f}{:>11.3g}{:>6.1f}s".format(
+        k, r["stiffness"], r["restitution_coef"], r["radius"], r["seed"], r["mean_height"],
+        r["packing_fraction"], r["coordination"], r["kinetic_energy"], r["wall_time"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    for name, default in PARAMS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=type(default), nargs="+", default=[default],
+                            metavar="V", help="the values of {} (default {})".format(name, default))
+    parser.add_argument("--seeds", type=int, help="use the seeds 0 to SEEDS-1")
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--dt", type=float, default=0.005)
+    parser.add_argument("--sleep", action="store_true", help="put the grains at rest to sleep")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--snapshots", help="save the final domain of each case in this directory")
+    parser.add_argument("-o", "--output", default="ensemble.csv", help="the csv file of the results")
+    args = parser.parse_args()
+    if args.seeds is not None:
+        args.seed = list(range(args.seeds))
+
+    cases = expand({name: getattr(args, name) for name in PARAMS})
+    results = run_ensemble(cases, steps=args.steps, dt=args.dt, sleep=args.sleep,
+                           workers=args.workers, snapshot_dir=args.snapshots)
+    write_results(args.output, results)
@@ -0,0 +1,268 @@
+"""multi-core domain decomposition for minidem.
+
+The grain and bond arrays of minidem.simu are moved to shared memory and
+the domain is split in vertical slabs, one per worker process. The slab
+bounds are aligned on the columns of the lcm grid and balanced on the grain
+count at the beginning of each block of iterations. At each iteration, a
+worker copies the grains of its slab plus a halo (the grains that may
+touch or be bonded to them) from the shared arrays, runs
+minidem.time_step on this local copy and writes back the grains it owns.
+Two barriers per iteration separate the reads of the shared arrays from the
+writes, so the results are the same as a serial run of minidem.time_step
+up to the order of the floating point sums.
+
+    import minidem as dem, dem_parallel
+    ...
+    dem_parallel.run_parallel(2000, n_workers=8, dt=0.005)
+
+The walls of minidem.simu (see minidem.wall_contacts) are shared too, each
+worker collides its grains with all of them and the first one moves them.
+Grains and walls can not be added or removed while a slab_pool is open.
+The workers run minidem.time_step at the fixed dt of the pool, so the sleep
+of the grains at rest (minidem.sleep_control) is not supported: a
+simulation with a sleep control is rejected."""
+
+import multiprocessing as mp
+import multiprocessing.connection
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import minidem as dem
+
+
+def _create_shared(arr):
+    """returns a shared memory block holding a copy of arr and its view"""
+    shm  = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    view[...] = arr
+    return shm, view
+
+
+def _attach_shared(name, shape, dtype):
+    # the workers share the resource tracker of the parent process, which
+    # unlinks the block in slab_pool.close
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+class slab_pool:
+    """a pool of worker processes that advance minidem.simu by domain
+decomposition with the standard iteration minidem.time_step(dt, **params).
+It must be closed (or used in a with statement) to get back the arrays in
+private memory."""
+    def __init__(self, n_workers, dt, **params):
+        if dem.simu.sleep is not None:
+            raise ValueError("dem_parallel does not support the sleep control of the grains (simu.sleep)")
+        self.sim       = dem.simu
+        self.n_workers = n_workers
+        self.dt        = dt
+        # the time step of the run, for the observers and the checkpoints
+        self.sim.dt    = dt
+        self.params    = params
+        self._shm      = []
+        grains, bonds  = self.sim.grains, self.sim.bonds
+        self._n_grain  = grains.n
+        self._n_wall   = self.sim.walls.n
+
+        specs = {}
+        for prefix, store in (("grain", grains), ("bond", bonds), ("wall", self.sim.walls)):
+            for name in store.fields:
+                shm, view = _create_shared(store._data[name][:store.n])
+                store._data[name] = view
+                self._shm.append(shm)
+                specs[prefix, name] = (shm.name, view.shape, view.dtype)
+        for name, arr in (("ctrl", np.zeros(2, dtype=np.int64)),
+                          ("bounds", np.zeros(n_workers + 1)),
+                          ("alive", np.ones(bonds.n, dtype=bool))):
+            shm, view = _create_shared(arr)
+            setattr(self, "_" + name, view)
+            self._shm.append(shm)
+            specs[name] = (shm.name, view.shape, view.dtype)
+
+        context = mp.get_context()
+        self._block = context.Barrier(n_workers + 1)
+        self._step  = context.Barrier(n_workers)
+        self._workers = [context.Process(target=_worker, daemon=True,
+                                         args=(rank, specs, self._block, self._step, dt, params))
+                         for rank in range(n_workers)]
+        for w in self._workers:
+            w.start()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        """break the barriers if a worker dies before the pool is closed, so
+that step raises instead of waiting forever"""
+        mp.connection.wait([w.sentinel for w in self._workers])
+        if self._shm:
+            self._block.abort()
+            self._step.abort()
+
+    def _balance(self):
+        """split the domain in slabs with the same number of grains, the
+bounds being aligned on the columns of the lcm grid"""
+        x = self.sim.grains.pos[:,0]
+        alpha = 2*dem.lcm.k*self.sim.grains.radius.max()
+        q = np.quantile(x, np.linspace(0., 1., self.n_workers + 1)[1:-1])
+        q = x.min() + np.round((q - x.min())/alpha)*alpha
+        self._bounds[:] = np.concatenate(([-np.inf], q, [np.inf]))
+
+    def _wait(self):
+        try:
+            self._block.wait()
+        except threading.BrokenBarrierError:
+            raise RuntimeError("a dem_parallel worker failed") from None
+
+    def step(self, n=1):
+        """run n iterations in parallel, then remove the broken bonds and
+update the iteration number and time of the simulation"""
+        sim = self.sim
+        if (sim.grains.n != self._n_grain or sim.walls.n != self._n_wall
+                or sim.grains._data["pos"].base is None):
+            raise RuntimeError("grains or walls were added or removed while the slab_pool is open")
+        self._balance()
+        self._ctrl[:] = (n, sim.bonds.n)
+        self._wait()
+        self._wait()
+
+        broken = ~self._alive[:sim.bonds.n]
+        if broken.any():
+            with sim:
+                dem.remove_bonds(broken)
+            self._alive[:sim.bonds.n] = True
+        for i in range(n):
+            sim.current_iter_number += 1
+            sim.t += self.dt
+
+    def run(self, tot_iter_number):
+        """run tot_iter_number iterations in blocks, the observers of the
+simulation are called as Simulation.step does"""
+        sim = self.sim
+        sim.tot_iter_number = sim.current_iter_number + tot_iter_number
+        done = 0
+        while done < tot_iter_number:
+            n = tot_iter_number - done
+            for callback, every in sim.observers:
+                n = min(n, every - sim.current_iter_number % every)
+            self.step(n)
+            done += n
+            for callback, every in sim.observers:
+                if sim.current_iter_number % every == 0:
+                    callback(sim)
+
+    def close(self):
+        if not self._shm:
+            return
+        self._ctrl[0] = -1
+        shm, self._shm = self._shm, []
+        try:
+            self._block.wait(timeout=10)
+        except threading.BrokenBarrierError:
+            pass
+        for w in self._workers:
+            w.join(timeout=10)
+            if w.is_alive():
+                w.terminate()
+        for store in (self.sim.grains, self.sim.bonds, self.sim.walls):
+            for name in store.fields:
+                store._data[name] = np.array(store._data[name])
+        for block in shm:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_parallel(tot_iter_number, n_workers, dt, **params):
+    """run tot_iter_number standard iterations of minidem.simu on n_workers
+processes, params are given to minidem.time_step"""
+    with slab_pool(n_workers, dt, **params) as pool:
+        pool.run(tot_iter_number)
+
+
+def _worker(rank, specs, block, step, dt, params):
+    shms, g, b, w = [], {}, {}, {}
+    for key, (name, shape, dtype) in specs.items():
+        shm, view = _attach_shared(name, shape, dtype)
+        shms.append(shm)
+        if key[0] == "grain":
+            g[key[1]] = view
+        elif key[0] == "bond":
+            b[key[1]] = view
+        elif key[0] == "wall":
+            w[key[1]] = view
+        else:
+            g["_" + key] = view
+    ctrl, bounds, alive = g.pop("_ctrl"), g.pop("_bounds"), g.pop("_alive")
+    try:
+        while True:
+            block.wait()
+            n, n_bond = (int(v) for v in ctrl)
+            if n < 0:
+                break
+            lo, hi = bounds[rank], bounds[rank+1]
+            for k in range(n):
+                _slab_step(g, b, w, alive, n_bond, lo, hi, rank, step, dt, params)
+            block.wait()
+    except threading.BrokenBarrierError:
+        pass
+    except BaseException:
+        block.abort()
+        step.abort()
+        raise
+    finally:
+        for shm in shms:
+            shm.close()
+
+
+def _slab_step(g, b, w, alive, n_bond, lo, hi, rank, step, dt, params):
+    """one iteration for the grains with lo <= x < hi"""
+    pos, radius = g["pos"], g["radius"]
+    x   = pos[:,0]
+    own = (x >= lo) & (x < hi)
+
+    # the halo holds the grains that may touch or be bonded to an owned one
+    bi, bj, live = b["i"][:n_bond], b["j"][:n_bond], alive[:n_bond].copy()
+    halo = 2*dem.lcm.k*radius.max()
+    if live.any():
+        rel_pos = pos[bj[live]] - pos[bi[live]]
+        halo = max(halo, np.sqrt(rel_pos[:,0]**2 + rel_pos[:,1]**2).max())
+    halo *= 1.01
+    idx = np.flatnonzero((x >= lo - halo) & (x < hi + halo))
+    loc = np.full(len(x), -1)
+    loc[idx] = np.arange(len(idx))
+
+    sim = dem.simu = dem.Simulation()
+    grains = sim.grains
+    grains.extend(pos[idx], radius[idx], g["density"][idx], g["vel"][idx])
+    grains.mass  = g["mass"][idx]
+    grains.acc   = g["acc"][idx]
+    grains.force = g["force"][idx]
+    sim.grain_list.extend_lazy(len(idx))
+    rows = np.flatnonzero(live & (loc[bi] >= 0) & (loc[bj] >= 0) & (own[bi] | own[bj]))
+    sim.bonds.append_rows(loc[bi[rows]], loc[bj[rows]], b["lo"][rows], b["surface"][rows], b["mass"][rows])
+    sim.bond_list.extend_lazy(len(rows))
+    walls = sim.walls
+    rows_w = walls._append(len(w["a"]))
+    for name in walls.fields:
+        walls._data[name][rows_w] = w[name]
+
+    dem.time_step(dt, **params)
+
+    # all the workers have read the shared arrays before any write
+    step.wait()
+    mine = own[idx]
+    out  = idx[mine]
+    for name in ("pos", "vel", "acc", "force"):
+        g[name][out] = grains._data[name][:grains.n][mine]
+    broken = np.setdiff1d(rows, rows[sim.bonds.uid])
+    alive[broken] = False
+    if rank == 0:
+        w["a"][:] = walls.a
+        w["b"][:] = walls.b
+    step.wait()
@@ -0,0 +1,168 @@
+"""render a video offline from a recorded minidem trajectory (see
+minidem.trajectory_recorder) or from a series of xyzr or .dem domain files
+(see minidem.save_domain). The frames are split in contiguous ranges that are
+rasterised in a process pool, each worker encoding its own video segment,
+and the segments are then concatenated (without re-encoding) in one MP4.
+
+    python dem_render.py dem_simulation.traj -o dem_simulation.mp4
+    python dem_render.py "domains/*.txt" -o settle.mp4 --html settle.html
+    python dem_render.py dem_simulation.traj --png-dir frames
+
+you need ffmpeg for the MP4 and HTML5 outputs"""
+
+import argparse
+import base64
+import concurrent.futures
+import contextlib
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+
+import minidem as dem
+
+
+@contextlib.contextmanager
+def open_source(source):
+    """a context manager that gives the number of frames of source and a
+function that gives the frame k as (title, pos, radius, bonds). A
+trajectory file is closed on exit."""
+    if source.endswith(".traj"):
+        with dem.trajectory_reader(source) as reader:
+            def get(k):
+                f = reader.frame(k)
+                return "iteration = {}, t = {:.3f}".format(f.iteration, f.t), f.pos, f.radius, f.bonds
+            yield len(reader), get
+        return
+    files = sorted(glob.glob(source))
+    def get(k):
+        domain = dem.read_domain(files[k])
+        return os.path.basename(files[k]), domain.pos, domain.radius, domain.bonds
+    yield len(files), get
+
+
+def _figure(xlim, ylim):
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+    fig, ax = plt.subplots()
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    ax.set_aspect('equal', adjustable='box')
+    title = ax.text(0.5,0.85, "", bbox={'facecolor':'w', 'alpha':0.5, 'pad':5},
+                    transform=ax.transAxes, ha="center")
+    return fig, title, dem.collection_renderer(ax)
+
+
+def _draw(get, k, title, renderer):
+    text, pos, radius, bonds = get(k)
+    title.set_text(text)
+    renderer.update(pos, radius, pos[bonds[:,0]], pos[bonds[:,1]])
+
+
+def render_segment(source, frames, filename, options):
+    """rasterise the given frames of source in the video file filename, or
+in png files if filename is a directory"""
+    from matplotlib import animation
+    fig, title, renderer = _figure(options["xlim"], options["ylim"])
+    with open_source(source) as (n, get):
+        if os.path.isdir(filename):
+            for k in frames:
+                _draw(get, k, title, renderer)
+                fig.savefig(os.path.join(filename, "frame_{:06d}.png".format(k)), dpi=options["dpi"])
+            return filename
+        writer = animation.FFMpegWriter(fps=options["fps"], metadata=dict(artist='(c) minidem'),
+                                        bitrate=options["bitrate"])
+        with writer.saving(fig, filename, options["dpi"]):
+            for k in frames:
+                _draw(get, k, title, renderer)
+                writer.grab_frame()
+    return filename
+
+
+def concatenate(segments, filename):
+    """concatenate the video segments in filename without re-encoding"""
+    from matplotlib import rcParams
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file:
+        for segment in segments:
+            file.write("file '{}'\n".format(os.path.abspath(segment)))
+    try:
+        subprocess.run([rcParams["animation.ffmpeg_path"], "-y", "-loglevel", "error",
+                        "-f", "concat", "-safe", "0", "-i", file.name, "-c", "copy", filename],
+                       check=True)
+    finally:
+        os.remove(file.name)
+
+
+def html5_video(filename):
+    """returns an html video tag embedding the MP4 file, as
+matplotlib.animation.Animation.to_html5_video does"""
+    with open(filename, "rb") as file:
+        data = base64.b64encode(file.read()).decode("ascii")
+    return ('<video controls autoplay loop>\n'
+            '  <source type="video/mp4" src="data:video/mp4;base64,{}">\n'
+            '  Your browser does not support the video tag.\n'
+            '</video>'.format(data))
+
+
+def render(source, *, video_name=None, html_name=None, png_dir=None, workers=None,
+           every=1, fps=15, dpi=400, bitrate=1800, xlim=(0,100), ylim=(0,100)):
+    """render the frames of source with a pool of workers processes"""
+    with open_source(source) as (n, get):
+        frames = list(range(0, n, every))
+    if not frames:
+        raise ValueError("no frame to render in '{}'".format(source))
+    workers = workers or os.cpu_count()
+    size    = -(-len(frames)//workers)
+    ranges  = [frames[k:k+size] for k in range(0, len(frames), size)]
+    options = dict(fps=fps, dpi=dpi, bitrate=bitrate, xlim=xlim, ylim=ylim)
+
+    if png_dir is not None:
+        os.makedirs(png_dir, exist_ok=True)
+        targets = [png_dir]*len(ranges)
+    else:
+        tmp = tempfile.mkdtemp(prefix="minidem_render_")
+        targets = [os.path.join(tmp, "segment_{:04d}.mp4".format(k)) for k in range(len(ranges))]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        segments = list(pool.map(render_segment, [source]*len(ranges), ranges, targets, [options]*len(ranges)))
+
+    if png_dir is None:
+        try:
+            video_name = video_name or os.path.join(tmp, "video.mp4")
+            concatenate(segments, video_name)
+            print("saving '{}'".format(video_name))
+            if html_name is not None:
+                with open(html_name, "w") as f:
+                    print(html5_video(video_name), file=f)
+                print("saving '{}'".format(html_name))
+        finally:
+            shutil.rmtree(tmp)
+    else:
+        print("saving {} frames in '{}'".format(len(frames), png_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="a .traj trajectory or a glob pattern of domain files")
+    parser.add_argument("-o", "--output", help="the MP4 file")
+    parser.add_argument("--html", help="an html file embedding the video")
+    parser.add_argument("--png-dir", help="write png frames in this directory instead of a video")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--every", type=int, default=1, help="render one frame every EVERY")
+    parser.add_argument("--fps", type=int, default=15)
+    parser.add_argument("--dpi", type=int, default=400)
+    parser.add_argument("--bitrate", type=int, default=1800)
+    parser.add_argument("--xlim", type=float, nargs=2, default=(0,100))
+    parser.add_argument("--ylim", type=float, nargs=2, default=(0,100))
+    args = parser.parse_args()
+    if args.output is None and args.html is None and args.png_dir is None:
+        parser.error("give at least one of --output, --html or --png-dir")
+    try:
+        render(args.source, video_name=args.output, html_name=args.html, png_dir=args.png_dir,
+               workers=args.workers, every=args.every, fps=args.fps, dpi=args.dpi,
+               bitrate=args.bitrate, xlim=tuple(args.xlim), ylim=tuple(args.ylim))
+    except ValueError as e:
+        parser.error(str(e))
@@ -1,68 +1,119 @@
 import minidem as dem
 import random
+import sys
 
 dt = 0.005
 t  = 0
+neighbours = dem.neighbour_list(expand_ratio=1.1)
+dem.simu.render_mode = "collections"
+dem.simu.dt = dt
+# with --adaptive the time step is computed by the engine at each iteration
+# (see minidem.adaptive_time_step) instead of the fixed dt above
+stepper = dem.adaptive_time_step() if "--adaptive" in sys.argv else None
+# with --sleep the grains at rest in the packing are put to sleep and skipped
+# (see minidem.sleep_control)
+if "--sleep" in sys.argv:
+    dem.simu.sleep = dem.sleep_control()
+# --workers (see below) runs minidem.time_step at the fixed dt in each
+# worker, with its own pair search instead of the neighbour list: it can not
+# be combined with --sleep or --adaptive
+if "--workers" in sys.argv:
+    if "--headless" not in sys.argv:
+        sys.exit("--workers needs --headless")
+    for flag in ("--sleep", "--adaptive"):
+        if flag in sys.argv:
+            sys.exit("--workers can not be combined with {}".format(flag))
+pairs = None
 
     
 def apply_gravity():
-    for gr in dem.simu.grain_list:
-        gr.force = dem.vec(0., -9.81*gr.mass)
+    dem.apply_gravity(-9.81)
         
 def manage_contact():
-    l = dem.lcm.compute_colliding_pair()
-    for (gr1,gr2) in l:
-        dem.contact(gr1,gr2)
+    global pairs
+    pairs = neighbours.compute_pair_index()
+    dem.contact_pairs(*pairs)
 
 def velocity_verlet():
     global t, dt
+    if stepper is not None:
+        dt = stepper(*pairs)
     t = t + dt
-    for gr in dem.simu.grain_list:
-        a = gr.force/gr.mass
-        gr.vel += (gr.acc + a) * (dt/2.)
-        gr.pos += gr.vel * dt + 0.5*a*(dt**2.)
-        gr.acc  = a
+    dem.velocity_verlet(dt)
 
 def apply_boundaries():
-    for gr in dem.simu.grain_list:
-
-        if gr.pos[0] - gr.radius < 0:
-            gr.pos[0] = gr.radius
-            if gr.vel[0] < 0.:
-                gr.vel[0] *= -.9
-
-        elif gr.pos[0] + gr.radius > 100:
-            gr.pos[0] = 100 - gr.radius
-            if gr.vel[0] > 0.:
-                gr.vel[0] *= -.9
-
-        if gr.pos[1] - gr.radius < 0:
-            gr.pos[1] = gr.radius
-            if gr.vel[1] < 0.:
-                gr.vel[1] *= -.9
-            
-        elif gr.pos[1] + gr.radius > 100:
-            gr.pos[1] = 100 - gr.radius
-            if gr.vel[1] > 0.:
-                gr.vel[1] *= -.9
+    dem.wall_contacts(restitution_coef=.9)
 
 
 def time_loop():
     apply_gravity()
     manage_contact()
-    velocity_verlet()
     apply_boundaries()
+    velocity_verlet()
+    if dem.simu.sleep is not None:
+        dem.simu.sleep.update()
 
 
 avg_rad = 1.5
 mass = 1
 
-for x in range(2, 99, 5):
-    for y in range(2, 99, 5):
-        pos = (x + random.random(), y + random.random())
-        rad = avg_rad + random.random()
-        gr  = dem.grain(pos, rad, mass)
+# with --resume the run continues bit-for-bit from the last checkpoint
+# written with --checkpoint (see minidem.save_checkpoint) instead of
+# starting from new grains
+if "--resume" in sys.argv:
+    saved = dem.resume("dem_simulation.chk")
+    neighbours, stepper = saved["neighbours"], saved["stepper"]
+    t, dt = dem.simu.t, dem.simu.dt
+    if "--workers" in sys.argv and (stepper is not None or dem.simu.sleep is not None):
+        sys.exit("--workers can not resume a checkpoint of an --adaptive or --sleep run")
+else:
+    for x in range(2, 99, 5):
+        for y in range(2, 99, 5):
+            pos = (x + random.random(), y + random.random())
+            rad = avg_rad + random.random()
+            gr  = dem.grain(pos, rad, mass)
+    # the box is made of four walls (see minidem.wall_contacts), more walls
+    # can be added with dem.plane_wall and dem.segment_wall
+    dem.box_walls(xlim=(0,100), ylim=(0,100))
+tot_iter_number = 2000 - dem.simu.current_iter_number
+print ("time step {}, critical time step {:.5f}".format(dt, dem.critical_time_step()))
+
+# with --profile the time spent in each phase of the iterations is measured,
+# the summary is printed at the end of the run and the measures are logged
+# every 100 iterations in dem_simulation.prof.jsonl
+if "--profile" in sys.argv:
+    dem.simu.profile.enabled = True
+    dem.simu.add_observer(dem.profile_log("dem_simulation.prof.jsonl"), every=100)
+
+# with --checkpoint the full state is saved every 200 iterations in 
+# dem_simulation.chk, in the background and atomically, so that a killed 
+# run can be continued with --resume
+checkpoints = None
+if "--checkpoint" in sys.argv:
+    checkpoints = dem.checkpointer("dem_simulation.chk", neighbours=neighbours, stepper=stepper)
+    dem.simu.add_observer(checkpoints, every=200)
 
-dem.run(tot_iter_number=2000, update_plot_each=10, loop_fn=time_loop, video_name="dem_simulation.mp4")
+# run with --headless for computing without any plotting (on a cluster node),
+# the trajectory is then recorded every 10 iterations for offline analysis.
+# With --headless --workers N the domain is split in N slabs computed by N
+# processes (see dem_parallel)
+if "--headless" in sys.argv:
+    traj_name = "dem_simulation.traj"
+    if dem.simu.current_iter_number:
+        traj_name = "dem_simulation_{}.traj".format(dem.simu.current_iter_number)
+    with dem.trajectory_recorder(traj_name) as recorder:
+        dem.simu.add_observer(recorder, every=10)
+        if "--workers" in sys.argv:
+            import dem_parallel
+            workers = int(sys.argv[sys.argv.index("--workers") + 1])
+            dem_parallel.run_parallel(tot_iter_number, workers, dt, xlim=None, wall_restitution_coef=.9)
+        else:
+            dem.simu.run_headless(tot_iter_number, loop_fn=time_loop)
+else:
+    dem.run(tot_iter_number=tot_iter_number, update_plot_each=10, loop_fn=time_loop, video_name="dem_simulation.mp4")
+if checkpoints is not None:
+    checkpoints.close()
 dem.save_domain("compact-domain.txt")
-print ("The end")
\ No newline at end of file
+if neighbours.n_call:
+    print ("neighbour list rebuilt {} times over {} steps".format(neighbours.n_build, neighbours.n_call))
+print ("The end")
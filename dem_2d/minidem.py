@@ -4,17 +4,26 @@
 
 
 
-from matplotlib import pyplot as plt
-from matplotlib import animation
-from matplotlib.patches import ConnectionPatch
-import matplotlib.patches as mpatches
+# matplotlib is only imported when something is drawn, so that headless 
+# runs (see Simulation.step and Simulation.run_headless) do not need it
 import operator
+import collections
+import functools
+import itertools
+import io
+import json
 import math
+import mmap
+import os
+import pickle
+import struct
 import sys
+import threading
+import time
 import numpy as np
 
 # you can get the matplotlib figure and axis with
-# these two variables 
+# simu.fig and simu.ax once the plot is initialized
 
 
 def vec(x,y):
@@ -22,72 +31,760 @@ def vec(x,y):
     return np.array([x,y],dtype=float)
 
 
-class simu:
-    """a simple static class that configure a simulation"""
-    current_iter_number = 0
-    grain_list   = []
-    bond_list    = []
-    patch_list   = []
-    xlim         = (0,100)
-    ylim         = (0,100)    
-    _init_plot   = False
-    custom_title = False
-    msg_content  = ""
-    fig, ax = plt.subplots()
-    t, dt = 0., 0.
-
-    def print(*msg):
+def _array_field(name):
+    def getter(self):
+        return self._data[name][:self.n]
+    def setter(self, value):
+        self._data[name][:self.n] = value
+    return property(getter, setter)
+
+
+class _ArrayStore:
+    """base class of the structure-of-arrays stores. Each field is a numpy 
+array with one row per item, described in fields by its name, the shape of
+a row and its dtype. The arrays exposed by the attributes are views on the 
+first n rows of an over-allocated buffer, so they must be fetched again 
+after adding items. The version counter is incremented each time an item is
+added or removed."""
+    fields = {}
+
+    def __init__(self, capacity=64):
+        self.n = 0
+        self.version = 0
+        self._data = {}
+        for name, (shape, dtype) in self.fields.items():
+            self._data[name] = np.zeros((capacity,) + shape, dtype=dtype)
+
+    def __len__(self):
+        return self.n
+
+    def capacity(self):
+        return len(next(iter(self._data.values())))
+
+    def reserve(self, capacity):
+        """grow the buffers so that they can hold at least capacity items"""
+        if capacity <= self.capacity():
+            return
+        capacity = max(capacity, 2*self.capacity())
+        for name, old in self._data.items():
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            self._data[name] = new
+
+    def _append(self, count=1):
+        """make room for count new rows and returns the slice to fill"""
+        self.reserve(self.n + count)
+        rows = slice(self.n, self.n + count)
+        self.n += count
+        self.version += 1
+        return rows
+
+    def compact(self, keep):
+        """remove the rows where the boolean array keep is False, the kept 
+rows are shifted down and keep their order"""
+        m = int(np.count_nonzero(keep))
+        for arr in self._data.values():
+            arr[:m] = arr[:self.n][keep]
+            arr[m:self.n] = 0
+        self.n = m
+        self.version += 1
+
+    def __getstate__(self):
+        # only the n used rows are pickled (see save_checkpoint)
+        state = dict(self.__dict__)
+        state["_data"] = {name: arr[:self.n] for name, arr in self._data.items()}
+        return state
+
+
+class GrainArray(_ArrayStore):
+    """a structure-of-arrays store that keeps the data of all the grains in
+contiguous numpy arrays, one row per grain :
+ - pos, vel, acc, force, initial_pos : N x 2 arrays
+ - radius, mass, density : N arrays
+ - asleep, calm : N arrays used by sleep_control"""
+    fields = {"pos"         : ((2,), float),
+              "vel"         : ((2,), float),
+              "acc"         : ((2,), float),
+              "force"       : ((2,), float),
+              "initial_pos" : ((2,), float),
+              "radius"      : ((), float),
+              "mass"        : ((), float),
+              "density"     : ((), float),
+              "asleep"      : ((), bool),
+              "calm"        : ((), np.int32)}
+
+    pos         = _array_field("pos")
+    vel         = _array_field("vel")
+    acc         = _array_field("acc")
+    force       = _array_field("force")
+    initial_pos = _array_field("initial_pos")
+    radius      = _array_field("radius")
+    mass        = _array_field("mass")
+    density     = _array_field("density")
+    asleep      = _array_field("asleep")
+    calm        = _array_field("calm")
+
+    def add(self, pos, radius, density):
+        """append a grain at rest and returns its index"""
+        i = self._append().start
+        self._data["pos"][i] = pos
+        self._data["initial_pos"][i] = pos
+        self._data["radius"][i] = radius
+        self._data["density"][i] = density
+        self._data["mass"][i] = density*math.pi*radius**2
+        return i
+
+    def extend(self, pos, radius, density, vel=None):
+        """append many grains at once and returns the slice of the new rows"""
+        radius = np.asarray(radius, dtype=float)
+        rows = self._append(len(radius))
+        self._data["pos"][rows] = pos
+        self._data["initial_pos"][rows] = pos
+        self._data["radius"][rows] = radius
+        self._data["density"][rows] = density
+        self._data["mass"][rows] = self._data["density"][rows]*math.pi*radius**2
+        if vel is not None:
+            self._data["vel"][rows] = vel
+        return rows
+
+    def remove(self, index):
+        """remove the grain at index, the next grains are shifted by one row"""
+        keep = np.ones(self.n, dtype=bool)
+        keep[index] = False
+        self.compact(keep)
+
+
+class BondArray(_ArrayStore):
+    """a structure-of-arrays store for the bonds, one row per bond :
+ - i, j : the indices of the two bonded grains in the GrainArray
+ - lo : the rest length
+ - surface : the section of the bond
+ - mass : the reduced mass of the two grains
+ - uid : a unique id, that does not change when rows are shifted
+The set pairs holds the (min, max) index pairs of the bonded grains, so that
+bonded pairs are found in O(1), it is built on first use."""
+    fields = {"i"       : ((), np.intp),
+              "j"       : ((), np.intp),
+              "lo"      : ((), float),
+              "surface" : ((), float),
+              "mass"    : ((), float),
+              "uid"     : ((), np.intp)}
+
+    i       = _array_field("i")
+    j       = _array_field("j")
+    lo      = _array_field("lo")
+    surface = _array_field("surface")
+    mass    = _array_field("mass")
+    uid     = _array_field("uid")
+
+    def __init__(self, capacity=64):
+        _ArrayStore.__init__(self, capacity)
+        self._pairs   = None
+        self._row     = np.zeros(capacity, dtype=np.intp)
+        self._next_id = 0
+        self._damping = (None, None)
+        self._keys    = (None, None)
+
+    def add(self, i, j, grains):
+        """bond the grains i and j of grains at their current distance and 
+returns the row of the new bond"""
+        return self.extend([i], [j], grains).start
+
+    def extend(self, i, j, grains):
+        """bond the grains i[k] and j[k] of grains, returns the slice of the 
+new rows"""
+        i = np.asarray(i, dtype=np.intp)
+        j = np.asarray(j, dtype=np.intp)
+        pos, radius, mass = grains.pos, grains.radius, grains.mass
+        rel_pos = pos[j] - pos[i]
+        return self.append_rows(i, j, np.sqrt(rel_pos[:,0]*rel_pos[:,0] + rel_pos[:,1]*rel_pos[:,1]),
+                                math.pi*((radius[i]+radius[j])/2.)**2,
+                                (mass[i]*mass[j])/(mass[i]+mass[j]))
+
+    def append_rows(self, i, j, lo, surface, mass):
+        """append bonds with the given fields, returns the slice of the new 
+rows"""
+        i = np.asarray(i, dtype=np.intp)
+        j = np.asarray(j, dtype=np.intp)
+        rows = self._append(len(i))
+        self._data["i"][rows] = i
+        self._data["j"][rows] = j
+        self._data["lo"][rows] = lo
+        self._data["surface"][rows] = surface
+        self._data["mass"][rows] = mass
+        uid = np.arange(self._next_id, self._next_id + len(i))
+        self._next_id += len(i)
+        if self._next_id > len(self._row):
+            self._row = np.resize(self._row, max(self._next_id, 2*len(self._row)))
+        self._data["uid"][rows] = uid
+        self._row[uid] = np.arange(rows.start, rows.stop)
+        if self._pairs is not None:
+            self._pairs.update(zip(np.minimum(i, j).tolist(), np.maximum(i, j).tolist()))
+        return rows
+
+    @property
+    def pairs(self):
+        if self._pairs is None:
+            self._pairs = set(zip(np.minimum(self.i, self.j).tolist(), np.maximum(self.i, self.j).tolist()))
+        return self._pairs
+
+    def __getstate__(self):
+        state = _ArrayStore.__getstate__(self)
+        state.update(_pairs=None, _damping=(None, None), _keys=(None, None))
+        return state
+
+    def row(self, uid):
+        """returns the current row of the bond with the given uid"""
+        return self._row[uid]
+
+    def is_bonded(self, i, j):
+        return (min(i, j), max(i, j)) in self.pairs
+
+    def compact(self, keep):
+        removed = ~keep
+        i, j = self.i[removed], self.j[removed]
+        if self._pairs is not None:
+            self._pairs.difference_update(zip(np.minimum(i, j).tolist(), np.maximum(i, j).tolist()))
+        self._row[self.uid[removed]] = -1
+        _ArrayStore.compact(self, keep)
+        self._row[self.uid] = np.arange(self.n)
+
+    def remove_grain(self, index):
+        """shift the grain indices after the removal of the grain index, 
+the bonds attached to it must have been removed before"""
+        self.i[self.i > index] -= 1
+        self.j[self.j > index] -= 1
+        self.version += 1
+        self._pairs = None
+
+    def damping(self, stiffness, restitution_coef):
+        """returns the damping constants of all the bonds, they are cached 
+until the bonds or the parameters change"""
+        key, C = self._damping
+        if key != (self.version, stiffness, restitution_coef):
+            C = damping_factor(restitution_coef)*np.sqrt(stiffness*self.mass)
+            self._damping = ((self.version, stiffness, restitution_coef), C)
+        return C
+
+    def sorted_keys(self, n):
+        """returns the sorted pair keys of the bonded grains, see pair_key"""
+        key, keys = self._keys
+        if key != (self.version, n):
+            keys = np.sort(pair_key(self.i, self.j, n))
+            self._keys = ((self.version, n), keys)
+        return keys
+
+
+class WallArray(_ArrayStore):
+    """a structure-of-arrays store for the walls, one row per wall :
+ - a, b : two points of the wall
+ - vel : the velocity of the wall (see move_walls)
+ - plane : True for an infinite plane, the line through a and b that pushes
+   the grains on its left side (see plane_wall), False for a segment from a
+   to b that pushes the grains on both sides (see segment_wall)"""
+    fields = {"a"     : ((2,), float),
+              "b"     : ((2,), float),
+              "vel"   : ((2,), float),
+              "plane" : ((), bool)}
+
+    a     = _array_field("a")
+    b     = _array_field("b")
+    vel   = _array_field("vel")
+    plane = _array_field("plane")
+
+    def add(self, a, b, vel=(0.,0.), plane=False):
+        """append a wall and returns its index"""
+        i = self._append().start
+        self._data["a"][i] = a
+        self._data["b"][i] = b
+        self._data["vel"][i] = vel
+        self._data["plane"][i] = plane
+        return i
+
+
+class view_list(list):
+    """a list of view objects (grains or bonds) where the objects that were 
+not accessed yet are stored as None and created by factory(index) on first
+access, so that millions of items can be loaded without creating millions 
+of python objects. raw() iterates over the stored items, None included."""
+    def __init__(self, factory):
+        list.__init__(self)
+        self.factory = factory
+
+    def _get(self, k):
+        item = list.__getitem__(self, k)
+        if item is None:
+            item = self.factory(k if k >= 0 else k + len(self))
+            list.__setitem__(self, k, item)
+        return item
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self._get(x) for x in range(*k.indices(len(self)))]
+        return self._get(k)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self._get(k)
+
+    def __reversed__(self):
+        for k in reversed(range(len(self))):
+            yield self._get(k)
+
+    def extend_lazy(self, n):
+        """append n items that will be created on first access"""
+        list.extend(self, itertools.repeat(None, n))
+
+    def raw(self):
+        return list.__iter__(self)
+
+
+class profiler:
+    """measures where the time of the iterations goes. The time is 
+accumulated by phase (broad phase, contacts, bonds, integration, ...), a 
+phase nested in another one being subtracted from it, and counters 
+(candidate pairs, contacts, broken bonds, ...) and gauges (the lcm grid 
+shape) are recorded by the instrumented functions. Nothing is measured 
+while enabled is False, which is the default :
+
+    simu.profile.enabled = True
+    simu.run_headless(1000)   # prints the summary at the end of the run
+"""
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        """clear all the measures, the wall clock starts now"""
+        self.times    = collections.defaultdict(float)
+        self.calls    = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+        self.gauges   = {}
+        self.n_step   = 0
+        self._stack   = []
+        self._phase   = None
+        self._start   = time.perf_counter()
+        self._wall    = self._start
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.times[self._phase] += now - self._start
+        self._stack.append(self._phase)
+        self._phase, self._start = name, now
+        self.calls[name] += 1
+
+    def exit(self):
+        now = time.perf_counter()
+        self.times[self._phase] += now - self._start
+        self._phase, self._start = self._stack.pop(), now
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def wall_time(self):
+        return time.perf_counter() - self._wall
+
+    def snapshot(self):
+        """returns the current measures as a dict that can be saved in json"""
+        return {"iterations" : self.n_step,
+                "wall_time"  : self.wall_time(),
+                "times"      : dict(self.times),
+                "calls"      : dict(self.calls),
+                "counters"   : dict(self.counters),
+                "gauges"     : dict(self.gauges)}
+
+    def summary(self):
+        """returns a text table of the measures"""
+        wall = self.wall_time()
+        n    = max(self.n_step, 1)
+        lines = ["profile of {} iterations in {:.3f} s ({:.3f} ms per iteration)".format(
+                     self.n_step, wall, 1e3*wall/n),
+                 "{:<22}{:>10}{:>9}{:>12}".format("phase", "time (s)", "share", "ms/iter")]
+        untracked = wall - sum(self.times.values())
+        for name, t in sorted(self.times.items(), key=operator.itemgetter(1), reverse=True) + [("(not instrumented)", untracked)]:
+            lines.append("{:<22}{:>10.3f}{:>8.1f}%{:>12.4f}".format(name, t, 100*t/wall if wall else 0., 1e3*t/n))
+        if self.counters:
+            lines.append("{:<22}{:>19}{:>12}".format("counter", "total", "per iter"))
+            for name, value in self.counters.items():
+                lines.append("{:<22}{:>19}{:>12.1f}".format(name, value, value/n))
+        for name, value in self.gauges.items():
+            lines.append("{:<22}{:>19}".format(name, str(value)))
+        return "\n".join(lines)
+
+
+def _timed(name):
+    """a decorator that accumulates the time spent in the function in the 
+phase name of simu.profile"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            prof = simu.profile
+            if not prof.enabled:
+                return fn(*args, **kwargs)
+            prof.enter(name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                prof.exit()
+        return wrapper
+    return decorator
+
+
+class profile_log:
+    """an observer that appends the measures of simu.profile (see 
+profiler.snapshot) with the iteration number and the time to a file, as one
+json object per line. The values are cumulated since the beginning of the
+run.
+
+    simu.profile.enabled = True
+    with profile_log("run.prof.jsonl") as log:
+        simu.add_observer(log, every=100)
+        simu.run_headless(2000)
+"""
+    def __init__(self, filename):
+        # line buffered, so that the log can be followed during the run
+        self.file = open(filename, "w", buffering=1)
+
+    def __call__(self, sim):
+        record = {"iteration" : sim.current_iter_number, "t" : sim.t}
+        record.update(sim.profile.snapshot())
+        self.file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Simulation:
+    """the state of a simulation and the engine that advances it. 
+The time loop is run by step or run_headless without any plotting, the 
+plotting is an optional observer (see add_observer and plot_observer).
+With render_mode = "collections" all the grains are drawn as one 
+EllipseCollection and all the bonds as one LineCollection, which is much 
+faster than the default "patches" mode (one matplotlib patch per object).
+The functions of this module work on the current simulation, the module 
+attribute simu. Several simulations can live in one process, a with 
+statement makes one of them the current one :
+
+    sim = Simulation()
+    with sim:
+        grain((50,50), 1., 1.)
+        sim.run_headless(100, lambda: time_step(0.005))
+
+step and run_headless make their simulation the current one while they run."""
+    def __init__(self, xlim=(0,100), ylim=(0,100)):
+        self.current_iter_number = 0
+        self.tot_iter_number     = 0
+        self.grain_list   = view_list(lambda k: grain._view(k, self))
+        self.bond_list    = view_list(lambda k: bond._view(k, self))
+        self.patch_list   = []
+        self.xlim         = xlim
+        self.ylim         = ylim
+        self._init_plot   = False
+        self._style_changed = True
+        self._visible     = np.zeros(0, dtype=bool)
+        self.custom_title = False
+        self.msg_content  = ""
+        self.fig, self.ax = None, None
+        self.t, self.dt   = 0., 0.
+        self.grains       = GrainArray()
+        self.bonds        = BondArray()
+        self.walls        = WallArray()
+        self.loop_function = None
+        self.observers    = []
+        self.render_mode  = "patches"
+        self.profile      = profiler()
+        self.max_overlap  = 0.
+        self.sleep        = None
+        self._previous    = []
+
+    def __enter__(self):
+        global simu
+        self._previous.append(simu)
+        simu = self
+        return self
+
+    def __exit__(self, *exc):
+        global simu
+        simu = self._previous.pop()
+
+    def print(self, *msg):
         """display a msg in the left bottom corner of the simulation"""
-        simu.msg_content = ' '.join(map(str, msg))
+        self.msg_content = ' '.join(map(str, msg))
     
-    def init(tot_iter_number, update_plot_each, loop_function): 
-        simu.tot_iter_number  = tot_iter_number
-        simu.update_plot_each = update_plot_each
-        simu.loop_function    = loop_function
-        simu.init_plot()
+    def init(self, tot_iter_number, update_plot_each, loop_function): 
+        self.tot_iter_number  = tot_iter_number
+        self.update_plot_each = update_plot_each
+        self.loop_function    = loop_function
+        self.init_plot()
+
+    def add_observer(self, callback, every=1):
+        """call callback(simulation) each time the iteration number is a 
+multiple of every"""
+        self.observers.append((callback, every))
+
+    def remove_observer(self, callback):
+        self.observers = [(c, e) for (c, e) in self.observers if c is not callback]
+
+    def step(self, n=1):
+        """run n iterations of the loop function"""
+        with self:
+            self._step(n)
+
+    def _step(self, n):
+        prof = self.profile
+        for i in range(n):
+            if prof.enabled:
+                self._profiled_iteration(prof)
+                continue
+            self.loop_function()
+            self.current_iter_number += 1
+            self.t += self.dt
+            for callback, every in self.observers:
+                if self.current_iter_number % every == 0:
+                    callback(self)
+
+    def _profiled_iteration(self, prof):
+        # the time of the loop function that is not spent in an 
+        # instrumented phase is given to the "loop function" phase
+        prof.enter("loop function")
+        try:
+            self.loop_function()
+        finally:
+            prof.exit()
+        prof.n_step += 1
+        self.current_iter_number += 1
+        self.t += self.dt
+        for callback, every in self.observers:
+            if self.current_iter_number % every == 0:
+                prof.enter("observers")
+                try:
+                    callback(self)
+                finally:
+                    prof.exit()
+
+    def run_headless(self, tot_iter_number, loop_fn=None):
+        """run the calculation without drawing anything. If the profiler is 
+enabled, its summary is printed at the end of the run."""
+        if loop_fn is not None:
+            self.loop_function = loop_fn
+        self.tot_iter_number = self.current_iter_number + tot_iter_number
+        if self.profile.enabled:
+            self.profile.reset()
+        with self:
+            self._step(tot_iter_number)
+        if self.profile.enabled:
+            print(self.profile.summary())
 
-    def add_object_to_scene(obj):
+    def figure(self):
+        """returns the matplotlib figure and axis, they are created on the 
+first call"""
+        if self.fig is None:
+            from matplotlib import pyplot as plt
+            self.fig, self.ax = plt.subplots()
+        return self.fig, self.ax
+
+    def add_object_to_scene(self, obj):
+        import matplotlib.patches as mpatches
         if issubclass(type(obj), mpatches.Patch):
-            simu.ax.add_patch(obj)
-        simu.patch_list.append(obj)
+            self.figure()[1].add_patch(obj)
+        self.patch_list.append(obj)
         
-    def init_plot():
-        if (simu._init_plot is False):
-            simu._init_plot = True
+    def init_plot(self):
+        if (self._init_plot is False):
+            from matplotlib import pyplot as plt
+            from matplotlib.patches import ConnectionPatch
+            self._init_plot = True
             # init matplotlib figure
-            plt.xlim(simu.xlim)
-            plt.ylim(simu.ylim)
+            fig, ax = self.figure()
+            ax.set_xlim(self.xlim)
+            ax.set_ylim(self.ylim)
             
-            plt.gca().set_aspect('equal', adjustable='box')
-            simu.title = simu.ax.text(0.5,0.85, "", bbox={'facecolor':'w', 'alpha':0.5, 'pad':5},
-                                      transform=simu.ax.transAxes, ha="center")
-            simu.msg = simu.ax.text(0.01,0.01, "", transform=simu.ax.transAxes, ha="left")
+            ax.set_aspect('equal', adjustable='box')
+            self.title = ax.text(0.5,0.85, "", bbox={'facecolor':'w', 'alpha':0.5, 'pad':5},
+                                 transform=ax.transAxes, ha="center")
+            self.msg = ax.text(0.01,0.01, "", transform=ax.transAxes, ha="left")
+
 
+            if self.render_mode == "collections":
+                self._init_collections(ax)
+            else:
+                for grain in self.grain_list:
+                    grain.patch = plt.Circle((grain.pos[0], grain.pos[1]), grain.radius, facecolor=grain.color, edgecolor="black")
+                    self.patch_list.append(grain.patch)
+                    ax.add_patch(grain.patch)
 
-            for grain in simu.grain_list:
-                grain.patch = plt.Circle((grain.pos[0], grain.pos[1]), grain.radius, facecolor=grain.color, edgecolor="black")
-                simu.patch_list.append(grain.patch)
-                simu.ax.add_patch(grain.patch)
+                for bond in self.bond_list:
+                    bond.patch = ConnectionPatch((bond.gr1.pos[0], bond.gr1.pos[1]), (bond.gr2.pos[0], bond.gr2.pos[1]),
+                                                 coordsA="data", coordsB="data",axesA=ax,axesB=ax)
+                    self.patch_list.append(bond.patch)
+                    ax.add_patch(bond.patch)
 
-            for bond in simu.bond_list:
-                bond.patch = ConnectionPatch((bond.gr1.pos[0], bond.gr1.pos[1]), (bond.gr2.pos[0], bond.gr2.pos[1]),
-                                             coordsA="data", coordsB="data",axesA=simu.ax,axesB=simu.ax)
-                simu.patch_list.append(bond.patch)
-                simu.ax.add_patch(bond.patch)
+            from matplotlib.collections import LineCollection
+            self._wall_lines = LineCollection([], colors="black", linewidths=2.)
+            ax.add_collection(self._wall_lines)
+            self._wall_lines.set_segments(self._wall_segments())
+            self.patch_list.append(self._wall_lines)
 
-            simu.patch_list.append(simu.title)
-            simu.patch_list.append(simu.msg)
+            self.patch_list.append(self.title)
+            self.patch_list.append(self.msg)
             
 
-    def remove_object_from_scene(obj):
+    def _wall_segments(self):
+        # the planes are drawn as long segments, clipped by the axis
+        walls = self.walls
+        a, b = walls.a.copy(), walls.b.copy()
+        t = (b - a)[walls.plane]
+        length = 1e3*max(self.xlim[1] - self.xlim[0], self.ylim[1] - self.ylim[0])
+        t *= length/np.sqrt((t*t).sum(axis=1))[:,None]
+        a[walls.plane] -= t
+        b[walls.plane] += t
+        return np.stack((a, b), axis=1)
+
+    def remove_object_from_scene(self, obj):
         if hasattr(obj, 'patch'):
-            if (obj.patch in simu.patch_list):
-                simu.patch_list.remove(obj.patch)
+            if (obj.patch in self.patch_list):
+                self.patch_list.remove(obj.patch)
                 obj.patch.remove()
-                
 
+    @_timed("drawing")
+    def update_plot(self):
+        """update the matplotlib artists from the current state and returns 
+the list of the artists"""
+        self.init_plot()
+        info = "computing iteration = {}/{}".format(self.current_iter_number, self.tot_iter_number)
+        # print(info, ' '*10, end='\r') I disable it because it causes slowdown with idle
+        if self.custom_title == False:
+            self.title.set_text(info)
+            self.msg.set_text(self.msg_content)
+        else:
+            self.title.set_text(self.msg_content)
+    
+        if self.walls.vel.any():
+            self._wall_lines.set_segments(self._wall_segments())
+        if self.render_mode == "collections":
+            self._update_collections()
+        else:
+            for grain in self.grain_list:
+                grain.patch.center = (grain.pos[0], grain.pos[1])
+                grain.patch.radius = grain.radius
+                grain.patch.set_facecolor(grain.color)
+                grain.patch.set_visible(grain.visible)
+        
+            for bond in self.bond_list:
+                bond.patch.xy1 = (bond.gr1.pos[0], bond.gr1.pos[1])
+                bond.patch.xy2 = (bond.gr2.pos[0], bond.gr2.pos[1])
+
+        return self.patch_list
+
+    def _init_collections(self, ax):
+        self._renderer = collection_renderer(ax)
+        self._style_changed = True
+        self.patch_list.extend(self._renderer.artists)
+        self._update_collections()
+
+    def _update_collections(self):
+        # the colors and the visibility are gathered from the grain objects
+        # only when one of them was set (see grain.color) or grains were 
+        # added or removed, the other frames only use the arrays
+        if self._style_changed or len(self._visible) != self.grains.n:
+            self._update_style()
+        pos = self.grains.pos
+        self._renderer.update(pos, self.grains.radius, pos[self.bonds.i], pos[self.bonds.j],
+                              self._facecolors, self._visible)
+
+    def _update_style(self):
+        from matplotlib.colors import to_rgba_array
+        items   = list(self.grain_list.raw())
+        colors  = [gr._color if gr is not None else "tab:blue" for gr in items]
+        visible = np.fromiter((gr is None or gr._visible for gr in items), dtype=bool, count=len(items))
+        # each distinct color (a name or an rgb(a) tuple) is converted once
+        codes = {}
+        index = np.fromiter((codes.setdefault(c if isinstance(c, str) else tuple(c), len(codes)) for c in colors),
+                            dtype=np.intp, count=len(colors))
+        self._facecolors = to_rgba_array(list(codes))[index] if codes else np.zeros((0,4))
+        self._visible = visible
+        self._style_changed = False
+
+
+class collection_renderer:
+    """draws all the grains as one EllipseCollection and all the bonds as 
+one LineCollection on a matplotlib axis. The two collections are in 
+self.artists (for blitting)."""
+    def __init__(self, ax):
+        from matplotlib.collections import EllipseCollection, LineCollection
+        self.grains = EllipseCollection([], [], [], units="xy", offsets=np.zeros((0,2)),
+                                        offset_transform=ax.transData, edgecolor="black")
+        self.bonds  = LineCollection([], colors="black", linewidths=1.)
+        ax.add_collection(self.grains)
+        ax.add_collection(self.bonds)
+        self.artists = [self.grains, self.bonds]
+
+    def update(self, pos, radius, bond_start, bond_end, facecolors="tab:blue", visible=None):
+        """update the collections from the grain positions and radii and 
+the end points of the bonds. facecolors is a color or an N x 4 rgba array,
+the grains where visible is False are transparent"""
+        from matplotlib.colors import to_rgba_array
+        n = len(pos)
+        diameter = 2.*radius
+        self.grains.set_offsets(pos)
+        self.grains.set_widths(diameter)
+        self.grains.set_heights(diameter)
+        self.grains.set_angles(np.zeros(n))
+
+        face = np.empty((n, 4))
+        face[:] = to_rgba_array(facecolors)
+        edge = np.zeros_like(face)
+        edge[:,3] = 1.
+        if visible is not None:
+            face[~visible,3] = 0.
+            edge[~visible,3] = 0.
+        self.grains.set_facecolors(face)
+        self.grains.set_edgecolors(edge)
+        self.bonds.set_segments(np.stack((bond_start, bond_end), axis=1))
+
+
+class plot_observer:
+    """an observer that draws the simulation, to be given to 
+Simulation.add_observer. If filename is given (for instance "frame_{:06d}.png")
+each drawing is saved in the file formatted with the iteration number, 
+otherwise the figure is shown and refreshed."""
+    def __init__(self, filename=None, dpi=100):
+        self.filename = filename
+        self.dpi      = dpi
+
+    def __call__(self, sim):
+        from matplotlib import pyplot as plt
+        sim.update_plot()
+        if self.filename is not None:
+            sim.fig.savefig(self.filename.format(sim.current_iter_number), dpi=self.dpi)
+        else:
+            plt.pause(0.001)
+
+
+# the current simulation, the default one until another is entered
+simu = Simulation()
             
 
+def _grain_field(name):
+    def getter(self):
+        return self._sim.grains._data[name][self.index]
+    def setter(self, value):
+        self._sim.grains._data[name][self.index] = value
+    return property(getter, setter)
+
+
 class grain: 
     """grain class that represent a circular discrete element with a 
  - radius :  self.rad, 
@@ -96,61 +793,135 @@ class grain:
  - acceleration : self.acc 
  - force : self.force
  - mass : self.mass
+The data are stored in simu.grains, a grain object is only a view on the 
+row self.index of this store. It belongs to the simulation that was the 
+current one (see Simulation.__enter__) when it was created.
 """
+    pos         = _grain_field("pos")
+    vel         = _grain_field("vel")
+    acc         = _grain_field("acc")
+    force       = _grain_field("force")
+    initial_pos = _grain_field("initial_pos")
+    radius      = _grain_field("radius")
+    mass        = _grain_field("mass")
+
+    @property
+    def color(self):
+        return self._color
+
+    @color.setter
+    def color(self, color):
+        self._color = color
+        self._sim._style_changed = True
+
+    @property
+    def visible(self):
+        return self._visible
+
+    @visible.setter
+    def visible(self, visible):
+        self._visible = visible
+        self._sim._style_changed = True
+
     def __init__(self, pos, radius, density, color="tab:blue"): 
-        self.radius = float(radius)
         x,y = pos
-        self.pos     = vec(x,y)
-        self.mass    = density*math.pi*self.radius**2
-        self.vel     = vec(0.,0.)
-        self.acc     = vec(0.,0.)
-        self.force   = vec(0.,0.)
+        self._sim    = simu
+        self.index   = simu.grains.add((x,y), float(radius), density)
         self.color   = color
         self.visible = True
-        self.index  = len(simu.grain_list)
-        self.attached_bond = []
-        self.bonded_grain  = []
         simu.grain_list.append(self)
-        self.initial_pos = vec(x,y)
-        if (simu._init_plot == True):
-            self.patch = plt.Circle((self.pos[0], self.pos[1]), self.radius, facecolor=self.color, edgecolor="black")
-            simu.patch_list.append(self.patch)
-            simu.ax.add_patch(self.patch)        
+        if (simu._init_plot == True and simu.render_mode == "patches"):
+            self._add_patch()
+
+    def _add_patch(self):
+        from matplotlib import pyplot as plt
+        self.patch = plt.Circle((self.pos[0], self.pos[1]), self.radius, facecolor=self.color, edgecolor="black")
+        self._sim.patch_list.append(self.patch)
+        self._sim.ax.add_patch(self.patch)        
 
-    def add_bond(self, b, gr):
-        self.attached_bond.append(b)
-        self.bonded_grain.append(gr)
+    @classmethod
+    def _view(cls, index, sim):
+        """returns a grain object on an existing row of sim.grains"""
+        gr = cls.__new__(cls)
+        gr._sim, gr.index, gr._color, gr._visible = sim, index, "tab:blue", True
+        return gr
+
+    def _attached_rows(self):
+        bonds = self._sim.bonds
+        return np.nonzero((bonds.i == self.index) | (bonds.j == self.index))[0]
+
+    @property
+    def attached_bond(self):
+        return [self._sim.bond_list[k] for k in self._attached_rows()]
+
+    @property
+    def bonded_grain(self):
+        bonds = self._sim.bonds
+        rows  = self._attached_rows()
+        other = np.where(bonds.i[rows] == self.index, bonds.j[rows], bonds.i[rows])
+        return [self._sim.grain_list[k] for k in other]
 
     def is_bonded_to(self, gr):
-        return (gr in self.bonded_grain)
+        return self._sim.bonds.is_bonded(self.index, gr.index)
 
     def remove(self):
-        while (len(self.attached_bond) > 0):
-            self.attached_bond[0].remove()
-        simu.grain_list.remove(self)
-        simu.remove_object_from_scene(self)
+        sim, bonds = self._sim, self._sim.bonds
+        with sim:
+            remove_bonds((bonds.i == self.index) | (bonds.j == self.index))
+        bonds.remove_grain(self.index)
+        sim.grain_list.remove(self)
+        sim.grains.remove(self.index)
+        sim._style_changed = True
+        for gr in itertools.islice(sim.grain_list.raw(), self.index, None):
+            if gr is not None:
+                gr.index -= 1
+        sim.remove_object_from_scene(self)
         
 
+def _bond_field(name):
+    def getter(self):
+        bonds = self._sim.bonds
+        return bonds._data[name][bonds.row(self.uid)]
+    return property(getter)
+
+
 class bond:
-    """a simple class that represents an elastic bond between two grains """
+    """a simple class that represents an elastic bond between two grains.
+The data are stored in simu.bonds, a bond object is only a view on one row 
+of this store, it belongs to the simulation of its grains."""
+    lo      = _bond_field("lo")
+    surface = _bond_field("surface")
+
     def __init__(self, gr1, gr2): 
         self.gr1     = gr1
         self.gr2     = gr2
-        self.lo      = np.linalg.norm(gr2.pos - gr1.pos)
-        self.index   = len(simu.bond_list)
-        self.surface = math.pi*((gr1.radius+gr2.radius)/2.)**2
-        gr1.add_bond(self, gr2)
-        gr2.add_bond(self, gr1)
-        
-        simu.bond_list.append(self)
+        self._sim    = sim = gr1._sim
+        row          = sim.bonds.add(gr1.index, gr2.index, sim.grains)
+        self.uid     = sim.bonds.uid[row]
+        sim.bond_list.append(self)
+
+    @classmethod
+    def _view(cls, row, sim):
+        """returns a bond object on an existing row of sim.bonds"""
+        b = cls.__new__(cls)
+        b._sim = sim
+        b.uid = sim.bonds.uid[row]
+        b.gr1 = sim.grain_list[sim.bonds.i[row]]
+        b.gr2 = sim.grain_list[sim.bonds.j[row]]
+        return b
+
+    @property
+    def index(self):
+        return self._sim.bonds.row(self.uid)
 
     def remove(self):
-        self.gr1.attached_bond.remove(self)
-        self.gr2.attached_bond.remove(self)
-        simu.bond_list.remove(self)
-        simu.remove_object_from_scene(self)
+        mask = np.zeros(self._sim.bonds.n, dtype=bool)
+        mask[self.index] = True
+        with self._sim:
+            remove_bonds(mask)
         
 
+    @_timed("bonds")
     def update(self, stiffness=1e5, restitution_coef=0.1):
         rel_pos   = self.gr2.pos - self.gr1.pos
         dist      = np.linalg.norm(rel_pos)
@@ -159,6 +930,7 @@ class bond:
         force     = delta * stiffness
         if (force/self.surface) < -5e3:
             self.remove()
+            self._sim.profile.count("bonds broken")
             return
         force = normal * force
         self.gr1.force -= force
@@ -167,13 +939,69 @@ class bond:
         # manage damping factor
         M  = (self.gr1.mass*self.gr2.mass)/(self.gr1.mass+self.gr2.mass);
         K  = stiffness;
-        C  = 2.*(1./math.sqrt(1. + math.pow(math.pi/math.log(restitution_coef), 2)))*math.sqrt(K*M)
+        C  = damping_factor(restitution_coef)*math.sqrt(K*M)
         V  = (self.gr2.vel - self.gr1.vel) * normal
         force2     = C * V * normal
         self.gr1.force += force2
         self.gr2.force -= force2
         
+
+@_timed("bonds")
+def remove_bonds(mask):
+    """remove the bonds where the boolean array mask is True"""
+    mask = np.asarray(mask, dtype=bool)
+    if not mask.any():
+        return
+    bond_list = list(simu.bond_list.raw())
+    for k in np.nonzero(mask)[0]:
+        if bond_list[k] is not None:
+            simu.remove_object_from_scene(bond_list[k])
+    simu.bond_list[:] = itertools.compress(bond_list, ~mask)
+    simu.bonds.compact(~mask)
+
+
+@_timed("bonds")
+def update_bonds(stiffness=1e5, restitution_coef=0.1, tensile_strength=5e3):
+    """the vectorized version of bond.update for all the bonds of simu.bonds.
+The bonds where the tensile stress exceeds tensile_strength are broken and
+removed, the others add their elastic and damping forces to the grains. It 
+returns the number of broken bonds."""
+    bonds, grains = simu.bonds, simu.grains
+    if bonds.n == 0:
+        return 0
+    i, j = bonds.i, bonds.j
+    pos  = grains.pos
+    rel_pos   = pos[j] - pos[i]
+    dist      = np.sqrt(rel_pos[:,0]*rel_pos[:,0] + rel_pos[:,1]*rel_pos[:,1])
+    delta     = bonds.lo - dist
+    normal    = rel_pos/dist[:,None]
+    force     = delta * stiffness
+    broken    = (force/bonds.surface) < -tensile_strength
+    C         = bonds.damping(stiffness, restitution_coef)
+    n_broken  = int(np.count_nonzero(broken))
+    if n_broken:
+        ok = ~broken
+        i, j, normal, force, C = i[ok], j[ok], normal[ok], force[ok], C[ok]
         
+    force  = normal * force[:,None]
+    V      = (grains.vel[j] - grains.vel[i]) * normal
+    force2 = C[:,None] * V * normal
+    scatter_add(grains.force, i, j, force2 - force)
+
+    if n_broken:
+        remove_bonds(broken)
+        simu.profile.count("bonds broken", n_broken)
+    return n_broken
+
+
+@functools.lru_cache(maxsize=None)
+def damping_factor(restitution_coef):
+    """returns the factor that gives the damping constant C of a contact 
+from its stiffness K and reduced mass M : C = damping_factor*sqrt(K*M)"""
+    return 2.*(1./math.sqrt(1. + math.pow(math.pi/math.log(restitution_coef), 2)))
+
+
+@_timed("contacts")
 def contact(gr1, gr2, stiffness=1e5, restitution_coef=0.5, exclude_bonded_grain = False):
     """a function that computes contact between two grains. 
 If the contact is detected, repulsive force are computed.
@@ -184,7 +1012,9 @@ The repuslive force take into account stiffness and damping factor"""
     rel_pos   = gr2.pos - gr1.pos
     dist      = np.linalg.norm(rel_pos)
     delta     = -dist + gr1.radius + gr2.radius
+    simu.profile.count("candidate pairs")
     if (delta > 0.):
+        simu.profile.count("contacts")
         # compute normal force 
         normal     = rel_pos/dist
         force1     = normal * delta * stiffness
@@ -194,12 +1024,99 @@ The repuslive force take into account stiffness and damping factor"""
         # manage damping factor
         M  = (gr1.mass*gr2.mass)/(gr1.mass+gr2.mass);
         K  = stiffness;
-        C  = 2.*(1./math.sqrt(1. + math.pow(math.pi/math.log(restitution_coef), 2)))*math.sqrt(K*M)
+        C  = damping_factor(restitution_coef)*math.sqrt(K*M)
         V  = (gr2.vel - gr1.vel) * normal
         force2     = C * V * normal
         gr1.force += force2
         gr2.force -= force2
 
+
+@_timed("contacts")
+def contact_pairs(i, j, stiffness=1e5, restitution_coef=0.5, exclude_bonded_grain = False):
+    """the batched version of contact. It computes the contacts between the 
+grains i[k] and j[k] of simu.grains for all the pairs at once and adds the 
+repulsive and damping forces to simu.grains.force. It returns the number of
+pairs that are actually in contact, the largest overlap relative to the 
+smallest radius of the pair is kept in simu.max_overlap."""
+    grains = simu.grains
+    simu.profile.count("candidate pairs", len(i))
+    if (exclude_bonded_grain) is True:
+        keep = ~bonded_mask(i, j)
+        i, j = i[keep], j[keep]
+    pos, radius = grains.pos, grains.radius
+    rel_pos   = pos[j] - pos[i]
+    dist      = np.sqrt(rel_pos[:,0]*rel_pos[:,0] + rel_pos[:,1]*rel_pos[:,1])
+    delta     = -dist + radius[i] + radius[j]
+    touch     = delta > 0.
+    if not touch.all():
+        i, j, rel_pos, dist, delta = i[touch], j[touch], rel_pos[touch], dist[touch], delta[touch]
+    if len(i) == 0:
+        simu.max_overlap = 0.
+        return 0
+    simu.profile.count("contacts", len(i))
+    simu.max_overlap = (delta/np.minimum(radius[i], radius[j])).max()
+    if simu.sleep is not None:
+        _wake_touched(i, j)
+
+    # compute normal force 
+    normal = rel_pos/dist[:,None]
+    force1 = normal * delta[:,None] * stiffness
+
+    # manage damping factor
+    mass = grains.mass
+    M  = (mass[i]*mass[j])/(mass[i]+mass[j])
+    C  = damping_factor(restitution_coef)*np.sqrt(stiffness*M)
+    V  = (grains.vel[j] - grains.vel[i]) * normal
+    force2 = C[:,None] * V * normal
+
+    scatter_add(grains.force, i, j, force2 - force1)
+    return len(i)
+
+
+def _wake_touched(i, j):
+    """wake the sleeping grains touched by an awake grain faster than 
+simu.sleep.wake_velocity, (i, j) being the pairs in contact"""
+    asleep = simu.grains.asleep
+    si, sj = asleep[i], asleep[j]
+    mixed  = si != sj
+    if not mixed.any():
+        return
+    si = si[mixed]
+    sleeper = np.where(si, i[mixed], j[mixed])
+    vel = simu.grains.vel[np.where(si, j[mixed], i[mixed])]
+    fast = vel[:,0]*vel[:,0] + vel[:,1]*vel[:,1] > simu.sleep.wake_velocity**2
+    if fast.any():
+        simu.sleep.wake(sleeper[fast])
+
+
+def scatter_add(force, i, j, f):
+    """adds f[k] to force[i[k]] and -f[k] to force[j[k]] for all k"""
+    n   = len(force)
+    idx = np.concatenate((i, j))
+    for axis in range(force.shape[1]):
+        w = np.concatenate((f[:,axis], -f[:,axis]))
+        force[:,axis] += np.bincount(idx, weights=w, minlength=n)
+
+
+def pair_key(i, j, n):
+    """returns a unique int64 key for the unordered pairs (i[k], j[k])"""
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+    return np.minimum(i, j)*n + np.maximum(i, j)
+
+
+def bonded_mask(i, j):
+    """returns a boolean array that is True where the grains i[k] and j[k] 
+are linked by a bond"""
+    if simu.bonds.n == 0:
+        return np.zeros(len(i), dtype=bool)
+    n    = simu.grains.n
+    keys = simu.bonds.sorted_keys(n)
+    k    = pair_key(i, j, n)
+    pos  = np.minimum(np.searchsorted(keys, k), len(keys) - 1)
+    return keys[pos] == k
+
+
 def in_contact(gr1, gr2, expand_ratio=1.):
     """a function that returns True if gr1 and gr2 are in contact. It returns False otherwise"""
     rel_pos   = gr2.pos - gr1.pos
@@ -213,62 +1130,777 @@ def wall_contact(gr, delta, normal, stiffness=1e5):
     gr.force += force1
     
 
+def _wall_field(name):
+    def getter(self):
+        return self._sim.walls._data[name][self.index]
+    def setter(self, value):
+        self._sim.walls._data[name][self.index] = value
+    return property(getter, setter)
+
+
+class wall:
+    """a wall of simu.walls, created by plane_wall or segment_wall. Like 
+grain, it is only a view on the row self.index of the store. A moving wall
+is given a velocity :
+
+    piston = plane_wall((0, 80), (0, -1))
+    piston.vel = (0, -2)
+"""
+    a   = _wall_field("a")
+    b   = _wall_field("b")
+    vel = _wall_field("vel")
+
+    def __init__(self, a, b, vel=(0.,0.), plane=False):
+        self._sim  = simu
+        self.index = simu.walls.add(a, b, vel, plane)
+
+    @property
+    def plane(self):
+        return bool(self._sim.walls.plane[self.index])
+
+    @property
+    def normal(self):
+        """the unit normal of a plane, on the side of the grains"""
+        t = self.b - self.a
+        return vec(-t[1], t[0])/np.linalg.norm(t)
+
+
+def plane_wall(point, normal, vel=(0.,0.)):
+    """add an infinite plane through point that pushes the grains toward 
+normal and returns it"""
+    n = np.asarray(normal, dtype=float)
+    n = n/np.linalg.norm(n)
+    point = np.asarray(point, dtype=float)
+    return wall(point, point + (n[1], -n[0]), vel, plane=True)
+
+
+def segment_wall(a, b, vel=(0.,0.)):
+    """add a segment from a to b that pushes the grains on both sides and 
+returns it"""
+    return wall(a, b, vel, plane=False)
+
+
+def box_walls(xlim=(0,100), ylim=(0,100)):
+    """add the four planes of a rectangular box and returns them"""
+    return [plane_wall((xlim[0], 0.), ( 1., 0.)), plane_wall((xlim[1], 0.), (-1., 0.)),
+            plane_wall((0., ylim[0]), (0.,  1.)), plane_wall((0., ylim[1]), (0., -1.))]
+
+
+@_timed("walls")
+def wall_contacts(stiffness=1e5, restitution_coef=0.9):
+    """computes the contacts between the grains and all the walls of 
+simu.walls at once and adds the repulsive and damping forces to 
+simu.grains.force, the damping uses the velocity relative to the wall. 
+The planes are tested against all the grains in one pass, the segments 
+only against the grains of the nearby lcm cells (see lcm.segment_pairs).
+It returns the number of contacts. A sleeping grain touched by a moving 
+wall wakes up."""
+    grains, walls = simu.grains, simu.walls
+    if walls.n == 0 or grains.n == 0:
+        return 0
+    pos, radius = grains.pos, grains.radius
+    a, b, plane = walls.a, walls.b, walls.plane
+
+    # planes : signed distance of every grain to every plane
+    p = np.flatnonzero(plane)
+    t = b[p] - a[p]
+    n = np.stack((-t[:,1], t[:,0]), axis=1)/np.sqrt(t[:,0]*t[:,0] + t[:,1]*t[:,1])[:,None]
+    dist = pos @ n.T - (a[p]*n).sum(axis=1)
+    g1, k = np.nonzero(dist < radius[:,None])
+    w1, normal1, delta1 = p[k], n[k], radius[g1] - dist[g1,k]
+
+    # segments : closest point of the segment to the nearby grains
+    g2, s = lcm.segment_pairs(a[~plane], b[~plane])
+    w2 = np.flatnonzero(~plane)[s]
+    t  = b[w2] - a[w2]
+    u  = np.clip(((pos[g2] - a[w2])*t).sum(axis=1)/(t*t).sum(axis=1).clip(1e-300), 0., 1.)
+    rel_pos = pos[g2] - a[w2] - u[:,None]*t
+    dist2   = np.sqrt(rel_pos[:,0]*rel_pos[:,0] + rel_pos[:,1]*rel_pos[:,1])
+    touch   = (dist2 < radius[g2]) & (dist2 > 0.)
+    g2, w2, rel_pos, dist2 = g2[touch], w2[touch], rel_pos[touch], dist2[touch]
+
+    g = np.concatenate((g1, g2))
+    w = np.concatenate((w1, w2))
+    if len(g) == 0:
+        return 0
+    simu.profile.count("wall contacts", len(g))
+    normal = np.concatenate((normal1, rel_pos/dist2[:,None]))
+    delta  = np.concatenate((delta1, radius[g2] - dist2))
+    # called after contact_pairs, the wall overlaps count for the time step
+    simu.max_overlap = max(simu.max_overlap, (delta/radius[g]).max())
+    if simu.sleep is not None:
+        moving = walls.vel[w].any(axis=1)
+        simu.sleep.wake(g[moving])
+
+    C = damping_factor(restitution_coef)*np.sqrt(stiffness*grains.mass[g])
+    V = ((grains.vel[g] - walls.vel[w])*normal).sum(axis=1)
+    f = normal*(delta*stiffness - C*V)[:,None]
+    force = grains.force
+    for axis in range(2):
+        force[:,axis] += np.bincount(g, weights=f[:,axis], minlength=grains.n)
+    return len(g)
+
+
+def move_walls(dt):
+    """move the walls of simu.walls by their velocity during dt"""
+    walls = simu.walls
+    if walls.n and walls.vel.any():
+        walls.a += walls.vel*dt
+        walls.b += walls.vel*dt
+
+
+@_timed("gravity")
+def apply_gravity(g=-9.81):
+    """reset the force of all the grains to their weight"""
+    grains = simu.grains
+    grains.force[:,0] = 0.
+    grains.force[:,1] = g*grains.mass
+
+
+@_timed("integration")
+def velocity_verlet(dt):
+    """integrate the motion of all the grains with the velocity verlet scheme,
+the sleeping grains (see sleep_control) are not moved"""
+    grains = simu.grains
+    sleep  = simu.sleep
+    if sleep is not None and sleep.n_asleep():
+        if 2*sleep.n_asleep() > grains.n:
+            k = sleep.awake_index()
+            a = grains.force[k]/grains.mass[k,None]
+            vel = grains.vel[k] + (grains.acc[k] + a) * (dt/2.)
+            grains.vel[k] = vel
+            grains.pos[k] += vel * dt + 0.5*a*(dt**2.)
+            grains.acc[k] = a
+            return
+        # the sleeping grains have no velocity nor acceleration, without 
+        # force they stay in place
+        grains.force[sleep.asleep_index()] = 0.
+    a = grains.force/grains.mass[:,None]
+    grains.vel += (grains.acc + a) * (dt/2.)
+    grains.pos += grains.vel * dt + 0.5*a*(dt**2.)
+    grains.acc  = a
+
+
+@_timed("boundaries")
+def box_boundaries(xlim=(0,100), ylim=(0,100), restitution_coef=0.9):
+    """keep all the grains inside a rectangular box. A grain that crosses a 
+side is put back on it and its normal velocity is reflected and damped, a
+sleeping grain (see sleep_control) is woken up"""
+    grains = simu.grains
+    pos, vel, r = grains.pos, grains.vel, grains.radius
+    for axis, (lo, hi) in enumerate((xlim, ylim)):
+        p, v = pos[:,axis], vel[:,axis]
+        below = p - r < lo
+        above = ~below & (p + r > hi)
+        p[below] = lo + r[below]
+        p[above] = hi - r[above]
+        v[(below & (v < 0.)) | (above & (v > 0.))] *= -restitution_coef
+        if simu.sleep is not None:
+            simu.sleep.wake(below | above)
+    
+
+def critical_time_step(stiffness=1e5, restitution_coef=0.5, bond_stiffness=1e5, bond_restitution_coef=0.1):
+    """returns the critical time step of the velocity verlet scheme for the 
+contacts and the bonds of simu. A contact of stiffness K between two grains
+of reduced mass M oscillates at w = sqrt(K/M) with the damping ratio 
+z = damping_factor(e)/2. As the damping force uses the velocity of the 
+previous step, the scheme is stable for dt < sqrt(2)/((1+z)*w) (slightly 
+conservative) instead of 2/w. The lightest grains give the highest w. A 
+grain with several contacts vibrates faster than a single contact, so the 
+step that is used must be a fraction of this one (0.1 to 0.3)."""
+    grains, bonds = simu.grains, simu.bonds
+    if grains.n == 0:
+        return math.inf
+    def limit(K, M, e):
+        z = damping_factor(e)/2.
+        return math.sqrt(2.)/((1. + z)*math.sqrt(K/M))
+    dt = limit(stiffness, grains.mass.min()/2., restitution_coef)
+    if bonds.n:
+        dt = min(dt, limit(bond_stiffness, bonds.mass.min(), bond_restitution_coef))
+    return dt
+
+
+class _bound:
+    """the base of the engine helpers that work on the simulation current at
+their creation (kept in _sim) whatever the current one is when they are 
+called. The simulation is not pickled with them, an unpickled helper (see
+resume) works on the current simulation"""
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_sim"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._sim = simu
+
+
+class adaptive_time_step(_bound):
+    """an adaptive time step controller. Calling it after the forces are 
+computed (before velocity_verlet) returns the time step of the iteration 
+and sets the dt of its simulation. The step grows by the factor growth while the increase 
+of the largest overlap since the previous call (see contact_pairs) and the
+largest displacement in one step stay below half of max_overlap_increase 
+and max_displacement (relative to the radius), and it is multiplied by 
+shrink when one of them is exceeded. It is bounded by safety times the 
+critical time step while grains are in contact. When no grain is in 
+contact (dilute or free flight) and the candidate pairs (i, j) are given,
+it can reach max_ratio times the critical time step, but stays below 
+approach times the time before the next contact, so that the impacts are
+resolved with the stable step.
+
+    stepper = adaptive_time_step(stiffness=1e5)
+    def time_loop():
+        dem.apply_gravity()
+        i, j = dem.lcm.compute_pair_index()
+        dem.contact_pairs(i, j)
+        dem.velocity_verlet(stepper(i, j))
+"""
+    def __init__(self, stiffness=1e5, restitution_coef=0.5, bond_stiffness=1e5, bond_restitution_coef=0.1,
+                 safety=0.2, max_overlap_increase=0.01, max_displacement=0.1, growth=1.05, shrink=0.5,
+                 max_ratio=10., approach=0.1, dt=None):
+        self.stiffness        = stiffness
+        self.restitution_coef = restitution_coef
+        self.bond_stiffness   = bond_stiffness
+        self.bond_restitution_coef = bond_restitution_coef
+        self.safety           = safety
+        self.max_overlap_increase = max_overlap_increase
+        self.max_displacement = max_displacement
+        self.growth           = growth
+        self.shrink           = shrink
+        self.max_ratio        = max_ratio
+        self.approach         = approach
+        self.dt               = dt
+        self.n_shrink         = 0
+        self._overlap         = None
+        self._sim             = simu
+
+    def critical(self):
+        return critical_time_step(self.stiffness, self.restitution_coef,
+                                  self.bond_stiffness, self.bond_restitution_coef)
+
+    def time_to_contact(self, i, j):
+        """returns the shortest time before two grains of the pairs (i, j) 
+touch at their current velocities"""
+        grains = self._sim.grains
+        pos, vel, radius = grains.pos, grains.vel, grains.radius
+        rel_pos = pos[j] - pos[i]
+        rel_vel = vel[j] - vel[i]
+        dist    = np.sqrt(rel_pos[:,0]*rel_pos[:,0] + rel_pos[:,1]*rel_pos[:,1])
+        closing = -(rel_pos[:,0]*rel_vel[:,0] + rel_pos[:,1]*rel_vel[:,1])/dist
+        gap     = dist - radius[i] - radius[j]
+        coming  = closing > 0.
+        if not coming.any():
+            return math.inf
+        return max((gap[coming]/closing[coming]).min(), 0.)
+
+    def __call__(self, i=None, j=None):
+        grains = self._sim.grains
+        if grains.n == 0:
+            return self.dt or self._sim.dt
+        dt_c   = self.critical()
+        stable = self.safety*dt_c
+        dt     = self.dt or stable
+        vel = grains.vel
+        displacement = math.sqrt((vel[:,0]*vel[:,0] + vel[:,1]*vel[:,1]).max())*dt/grains.radius.min()
+        overlap  = self._sim.max_overlap
+        increase = overlap - self._overlap if self._overlap is not None else 0.
+        self._overlap = overlap
+        if increase > self.max_overlap_increase or displacement > self.max_displacement:
+            dt *= self.shrink
+            self.n_shrink += 1
+        elif increase < self.max_overlap_increase/2. and displacement < self.max_displacement/2.:
+            dt *= self.growth
+
+        if overlap > 0. or self._sim.bonds.n > 0 or i is None:
+            limit = stable
+        else:
+            limit = self.max_ratio*dt_c
+            if len(i):
+                limit = min(limit, max(stable, self.approach*self.time_to_contact(i, j)))
+        # the step is never reduced below a thousandth of the stable one
+        self.dt = self._sim.dt = max(min(dt, limit), 1e-3*stable)
+        return self.dt
+
+
+class sleep_control(_bound):
+    """puts to sleep the grains that stay calm (speed below velocity and, if 
+it is given, net acceleration below acceleration) during steps iterations,
+so that settled packings cost nearly nothing. The grains resting on the 
+box have the acceleration of gravity (box_boundaries is not a force), so 
+the acceleration criterion only suits scenes held by walls or bonds. It is
+enabled by
+
+    simu.sleep = sleep_control()
+
+and update must be called at the end of each iteration (time_step does it).
+The sleeping grains are not moved by velocity_verlet and lcm skips the 
+pairs of two sleeping grains when most grains sleep, the awake grains still
+collide with them as with fixed obstacles. A sleeping grain wakes up when an 
+awake grain faster than wake_velocity touches it (see contact_pairs), when 
+box_boundaries has to put it back in the box, when a moving wall touches
+it (see wall_contacts) or when wake is called. A woken grain moves again 
+from the next iteration on."""
+    def __init__(self, velocity=0.1, acceleration=None, steps=50, wake_velocity=None):
+        self.velocity      = velocity
+        self.acceleration  = acceleration
+        self.steps         = steps
+        self.wake_velocity = velocity if wake_velocity is None else wake_velocity
+        # incremented each time grains wake up, the pairs of the broad phase
+        # given before are no longer complete (see neighbour_list)
+        self.n_wake  = 0
+        self._n_wake = 0
+        self._awake  = None
+        self._asleep = None
+        self._key    = None
+        self._sim    = simu
+
+    def n_asleep(self):
+        return len(self.asleep_index())
+
+    def awake_index(self):
+        """returns the indices of the grains that were awake at the last 
+update"""
+        self._refresh()
+        return self._awake
+
+    def asleep_index(self):
+        """returns the indices of the grains that were asleep at the last 
+update"""
+        self._refresh()
+        return self._asleep
+
+    def _refresh(self):
+        grains = self._sim.grains
+        if self._awake is None or self._key != grains.version:
+            asleep = grains.asleep
+            self._awake, self._asleep = np.flatnonzero(~asleep), np.flatnonzero(asleep)
+            self._key = grains.version
+
+    def wake(self, index):
+        """wake up the grains index (an index array or a boolean mask)"""
+        grains = self._sim.grains
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        index = index[grains.asleep[index]]
+        if len(index):
+            grains.asleep[index] = False
+            grains.calm[index]   = 0
+            self.n_wake += 1
+            self._sim.profile.count("grains woken", len(index))
+
+    def update(self):
+        """count the calm iterations of the awake grains and put to sleep 
+the ones that were calm long enough"""
+        grains = self._sim.grains
+        k   = self.awake_index()
+        vel = grains.vel[k]
+        calm = vel[:,0]*vel[:,0] + vel[:,1]*vel[:,1] < self.velocity**2
+        if self.acceleration is not None:
+            a = grains.force[k]/grains.mass[k,None]
+            calm &= a[:,0]*a[:,0] + a[:,1]*a[:,1] < self.acceleration**2
+        count = np.where(calm, grains.calm[k] + 1, 0)
+        grains.calm[k] = count
+        tired = k[count >= self.steps]
+        if len(tired):
+            grains.asleep[tired] = True
+            grains.vel[tired] = 0.
+            grains.acc[tired] = 0.
+            self._sim.profile.count("grains put to sleep", len(tired))
+        # the woken grains (asleep is False) are taken into account now
+        if len(tired) or self.n_wake != self._n_wake:
+            self._awake = None
+            self._n_wake = self.n_wake
+        self._sim.profile.gauge("awake grains", len(self.awake_index()))
+
+
+def time_step(dt, gravity=-9.81, stiffness=1e5, restitution_coef=0.5, exclude_bonded_grain=False,
+              bond_stiffness=1e5, bond_restitution_coef=0.1, tensile_strength=5e3,
+              xlim=(0,100), ylim=(0,100), wall_restitution_coef=0.9, wall_stiffness=1e5):
+    """a standard iteration that can be used as loop function : gravity, 
+contacts with a lcm broad phase, bonds, contacts with the walls of 
+simu.walls, velocity verlet integration, motion of the walls, box 
+boundaries (unless xlim is None) and the update of simu.sleep if it is 
+enabled"""
+    apply_gravity(gravity)
+    i, j = lcm.compute_pair_index()
+    contact_pairs(i, j, stiffness, restitution_coef, exclude_bonded_grain)
+    update_bonds(bond_stiffness, bond_restitution_coef, tensile_strength)
+    if simu.walls.n:
+        wall_contacts(wall_stiffness, wall_restitution_coef)
+    velocity_verlet(dt)
+    move_walls(dt)
+    if xlim is not None:
+        box_boundaries(xlim, ylim, wall_restitution_coef)
+    if simu.sleep is not None:
+        simu.sleep.update()
+
+
+Domain = collections.namedtuple("Domain", "pos radius density vel bonds")
+
+
 def save_domain(filename):
-    """save domain in file as xyzr format"""
-    with open(filename, 'w') as file:
-        for grain in simu.grain_list:
-            line = "{}\t{}\t{}\n".format(grain.pos[0], grain.pos[1], grain.radius)
-            file.write(line)
-        for bond in simu.bond_list:
-            line = "{}\t{}\n".format(bond.gr1.index, bond.gr2.index)
-            file.write(line)            
+    """save domain in file. A filename ending with .dem is written in the 
+binary format (see write_domain), any other one in the xyzr text format"""
+    grains, bonds = simu.grains, simu.bonds
+    if filename.endswith(".dem"):
+        write_domain(filename, Domain(grains.pos, grains.radius, grains.density, grains.vel,
+                                      np.stack((bonds.i, bonds.j), axis=1)))
+    else:
+        pos = grains.pos
+        with open(filename, 'w') as file:
+            file.writelines(map("{}\t{}\t{}\n".format, pos[:,0].tolist(), pos[:,1].tolist(), grains.radius.tolist()))
+            file.writelines(map("{}\t{}\n".format, bonds.i.tolist(), bonds.j.tolist()))
     print ("saving '{}'".format(filename))
 
     
-def load_domain(filename):
-    """load domain form a xyzr file"""
-    with open(filename, 'r') as file:
-        for line in file:
-            data = line.split()
-            if (len(data) == 3):
-                x = float(data[0])
-                y = float(data[1])
-                r = float(data[2])
-                gr = grain((x,y), r, 1)
-            elif (len(data) == 2):
-                gr1 = simu.grain_list[int(data[0])]
-                gr2 = simu.grain_list[int(data[1])]
-                b = bond(gr1,gr2)
+def load_domain(filename, density=1):
+    """load domain from a xyzr or a binary .dem file (see read_domain). The 
+grains and bonds are added in bulk to simu.grains and simu.bonds, their 
+python objects are only created when accessed through simu.grain_list and 
+simu.bond_list. density is used when the file does not give it. The bond 
+indices of the file refer to its own grains. The arrays are copied in the
+stores : use read_domain(filename, mmap=True) to read a .dem file without 
+copying it."""
+    domain = read_domain(filename)
+    if domain.density is not None:
+        density = domain.density
+    first = simu.grains.n
+    simu.grains.extend(domain.pos, domain.radius, density, domain.vel)
+    simu.grain_list.extend_lazy(len(domain.radius))
+    simu.bonds.extend(domain.bonds[:,0] + first, domain.bonds[:,1] + first, simu.grains)
+    simu.bond_list.extend_lazy(len(domain.bonds))
+    if (simu._init_plot == True and simu.render_mode == "patches"):
+        for gr in simu.grain_list[first:]:
+            gr._add_patch()
     print ("loading '{}'".format(filename))
 
 
+_domain_magic = b"MDEMDOM1"
+_domain_align = 64
+
+
+def write_domain(filename, domain):
+    """write a Domain in the binary format : a magic string, the byte length
+of a json header giving the dtype, shape and offset of each array, then the
+raw arrays aligned on 64 bytes so that they can be memory mapped. Each 
+array is written in one bulk write."""
+    arrays = [(name, np.ascontiguousarray(getattr(domain, name))) for name in Domain._fields]
+    header, offset = {}, 0
+    for name, arr in arrays:
+        header[name] = {"dtype": arr.dtype.str, "shape": arr.shape, "offset": offset}
+        offset += -(-arr.nbytes//_domain_align)*_domain_align
+    text  = json.dumps(header).encode()
+    start = len(_domain_magic) + 4 + len(text)
+    with open(filename, 'wb') as file:
+        file.write(_domain_magic)
+        file.write(struct.pack("<I", len(text)))
+        file.write(text)
+        file.write(b"\0"*(-start % _domain_align))
+        for name, arr in arrays:
+            arr.tofile(file)
+            file.write(b"\0"*(-arr.nbytes % _domain_align))
+
+
+def read_domain(filename, mmap=False):
+    """read a domain file without creating any grain and returns a Domain 
+(pos, radius, density, vel, bonds). For a binary .dem file (see 
+write_domain), the arrays are memory mapped read-only if mmap is True. For 
+a xyzr file (see save_domain), density and vel are None ; the text is 
+parsed at once : the tokens of each line are counted from the raw bytes, 
+all the numbers are parsed by numpy, then the lines with 3 tokens are 
+grains and the lines with 2 tokens are bonds."""
+    with open(filename, 'rb') as file:
+        if file.read(len(_domain_magic)) == _domain_magic:
+            size,  = struct.unpack("<I", file.read(4))
+            header = json.loads(file.read(size))
+            start  = file.tell() + (-file.tell() % _domain_align)
+            arrays = {}
+            for name, info in header.items():
+                dtype, shape = np.dtype(info["dtype"]), tuple(info["shape"])
+                if mmap and math.prod(shape):
+                    arrays[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                             offset=start + info["offset"], shape=shape)
+                else:
+                    file.seek(start + info["offset"])
+                    arrays[name] = np.fromfile(file, dtype=dtype, count=math.prod(shape)).reshape(shape)
+            return Domain(**arrays)
+        file.seek(0)
+        data = file.read()
+    raw   = np.frombuffer(data, dtype=np.uint8)
+    blank = (raw == ord(' ')) | (raw == ord('\t')) | (raw == ord('\n')) | (raw == ord('\r'))
+    first = ~blank
+    first[1:] &= blank[:-1]
+    # number of tokens of each line, then of the line of each token
+    line_end = np.append(np.flatnonzero(raw == ord('\n')), len(raw))
+    per_line = np.diff(np.searchsorted(np.flatnonzero(first), line_end), prepend=0)
+    per_line = np.repeat(per_line, per_line)
+    tokens     = np.fromstring(data, sep=" ")
+    pos_radius = tokens[per_line == 3].reshape(-1, 3)
+    bonds      = tokens[per_line == 2].astype(np.intp).reshape(-1, 2)
+    return Domain(pos_radius[:,:2].copy(), pos_radius[:,2].copy(), None, None, bonds)
+
+
+_checkpoint_magic = b"MDEMCHK1"
+
+
+def _checkpoint_data(sim, objects):
+    state = {"grains"              : sim.grains,
+             "bonds"               : sim.bonds,
+             "walls"               : sim.walls,
+             "t"                   : sim.t,
+             "dt"                  : sim.dt,
+             "current_iter_number" : sim.current_iter_number,
+             "tot_iter_number"     : sim.tot_iter_number,
+             "max_overlap"         : sim.max_overlap,
+             "sleep"               : sim.sleep,
+             "objects"             : objects}
+    return _checkpoint_magic + pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _write_atomic(filename, data):
+    """write data in a temporary file that replaces filename once it is on 
+disk, so that filename is always a complete file"""
+    tmp = filename + ".tmp"
+    with open(tmp, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, filename)
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def save_checkpoint(filename, **objects):
+    """save the full state of simu in filename : all the grain, bond and wall 
+arrays, the time, the iteration number and simu.sleep. The objects given 
+as keywords (a neighbour_list, an adaptive_time_step, ...) are saved too 
+and returned by resume, so that the run continues bit-for-bit. The file is
+written atomically (see checkpointer for periodic asynchronous checkpoints)"""
+    _write_atomic(filename, _checkpoint_data(simu, objects))
+
+
+def resume(filename):
+    """restore in simu, which must be empty, the state saved by 
+save_checkpoint and returns the dict of the saved objects. The loop 
+function and the observers are not saved, they must be given again."""
+    if simu.grains.n or simu.bonds.n or simu.walls.n:
+        raise ValueError("resume needs an empty simulation")
+    with open(filename, 'rb') as file:
+        if file.read(len(_checkpoint_magic)) != _checkpoint_magic:
+            raise ValueError("'{}' is not a minidem checkpoint".format(filename))
+        state = pickle.load(file)
+    simu.grains, simu.bonds, simu.walls = state["grains"], state["bonds"], state["walls"]
+    for name in ("t", "dt", "current_iter_number", "tot_iter_number", "max_overlap", "sleep"):
+        setattr(simu, name, state[name])
+    simu.grain_list.extend_lazy(simu.grains.n)
+    simu.bond_list.extend_lazy(simu.bonds.n)
+    if (simu._init_plot == True and simu.render_mode == "patches"):
+        for gr in simu.grain_list:
+            gr._add_patch()
+    print ("resuming '{}' at iteration {}".format(filename, simu.current_iter_number))
+    return state["objects"]
+
+
+class checkpointer:
+    """an observer that saves periodic checkpoints (see save_checkpoint), to 
+be given to Simulation.add_observer with the objects to save :
+
+    simu.add_observer(checkpointer("run.chk", neighbours=neighbours), every=1000)
+
+The state is serialized in memory in the time loop, then a background 
+thread writes it atomically while the loop goes on. A new checkpoint waits 
+for the previous write. filename can hold a {} replaced by the iteration 
+number, to keep all the checkpoints. The checkpointer must be closed (or 
+used in a with statement) to wait for the last write, the errors of the 
+writes are raised by the next call or by close."""
+    def __init__(self, filename, **objects):
+        self.filename = filename
+        self.objects  = objects
+        self.n_write  = 0
+        self._thread  = None
+        self._error   = None
+
+    def __call__(self, sim):
+        data = _checkpoint_data(sim, self.objects)
+        self.wait()
+        filename = self.filename.format(sim.current_iter_number)
+        self._thread = threading.Thread(target=self._write, args=(filename, data), daemon=True)
+        self._thread.start()
+
+    def _write(self, filename, data):
+        try:
+            _write_atomic(filename, data)
+            self.n_write += 1
+        except BaseException as error:
+            self._error = error
+
+    def wait(self):
+        """wait for the write in progress"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        self.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+Frame = collections.namedtuple("Frame", "iteration t pos vel radius bonds")
+
+
+class trajectory_recorder:
+    """an observer that records the trajectory of a simulation in a binary 
+file, to be given to Simulation.add_observer. The positions, velocities, 
+radii and bonded pairs of each observed iteration are buffered and written 
+as a compressed chunk every chunk_size frames, so the memory stays bounded.
+The file starts with a magic string, followed by the chunks, each one being
+a (byte length, number of frames) header and a compressed npz payload. The 
+recorder must be closed (or used in a with statement) to write the last 
+chunk. The file is read with trajectory_reader."""
+    magic = b"MDEMTRJ1"
+    chunk_header = struct.Struct("<QI")
+
+    def __init__(self, filename, chunk_size=100, dtype=float):
+        self.filename   = filename
+        self.chunk_size = chunk_size
+        self.dtype      = dtype
+        self.n_frame    = 0
+        self._file      = open(filename, "wb")
+        self._file.write(trajectory_recorder.magic)
+        self._buffer    = []
+
+    def __call__(self, sim):
+        grains, bonds = sim.grains, sim.bonds
+        self._buffer.append((sim.current_iter_number, sim.t,
+                             grains.pos.astype(self.dtype), grains.vel.astype(self.dtype),
+                             grains.radius.astype(self.dtype),
+                             np.stack((bonds.i, bonds.j), axis=1).astype(np.int32)))
+        self.n_frame += 1
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """write the buffered frames as one chunk"""
+        if not self._buffer:
+            return
+        iteration, t, pos, vel, radius, bonds = zip(*self._buffer)
+        data = io.BytesIO()
+        np.savez_compressed(data, iteration=np.array(iteration), t=np.array(t),
+                            n_grain=np.array([len(r) for r in radius]),
+                            n_bond=np.array([len(b) for b in bonds]),
+                            pos=np.concatenate(pos), vel=np.concatenate(vel),
+                            radius=np.concatenate(radius), bonds=np.concatenate(bonds))
+        data = data.getvalue()
+        self._file.write(trajectory_recorder.chunk_header.pack(len(data), len(self._buffer)))
+        self._file.write(data)
+        self._file.flush()
+        self._buffer = []
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class trajectory_reader:
+    """reads a trajectory written by trajectory_recorder. The file is memory
+mapped and only the chunk holding the requested frame is decompressed, the 
+last decompressed chunk is kept. The frames are returned as Frame tuples
+(iteration, t, pos, vel, radius, bonds). A truncated last chunk, for 
+instance after a crash, is ignored."""
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._map  = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = trajectory_recorder.magic
+        if self._map[:len(magic)] != magic:
+            raise ValueError("'{}' is not a minidem trajectory".format(filename))
+        header = trajectory_recorder.chunk_header
+        self._chunks = []
+        first, offset = 0, len(magic)
+        while offset + header.size <= len(self._map):
+            size, n = header.unpack_from(self._map, offset)
+            if offset + header.size + size > len(self._map):
+                break
+            self._chunks.append((first, offset + header.size, size))
+            first  += n
+            offset += header.size + size
+        self.n_frame = first
+        self._first  = np.array([c[0] for c in self._chunks], dtype=np.int64)
+        self._cache  = (None, None)
+
+    def __len__(self):
+        return self.n_frame
+
+    def _chunk(self, k):
+        index, data = self._cache
+        if index != k:
+            first, offset, size = self._chunks[k]
+            with np.load(io.BytesIO(self._map[offset:offset+size])) as npz:
+                data = {name: npz[name] for name in npz.files}
+            grain_end = np.cumsum(data["n_grain"])
+            bond_end  = np.cumsum(data["n_bond"])
+            data["grain_slices"] = np.stack((grain_end - data["n_grain"], grain_end), axis=1)
+            data["bond_slices"]  = np.stack((bond_end - data["n_bond"], bond_end), axis=1)
+            self._cache = (k, data)
+        return data
+
+    def frame(self, index):
+        """returns the frame number index"""
+        if index < 0:
+            index += self.n_frame
+        if not 0 <= index < self.n_frame:
+            raise IndexError("frame index out of range")
+        k = int(np.searchsorted(self._first, index, side="right")) - 1
+        data = self._chunk(k)
+        f = index - self._chunks[k][0]
+        a, b = data["grain_slices"][f]
+        c, d = data["bond_slices"][f]
+        return Frame(int(data["iteration"][f]), float(data["t"][f]), data["pos"][a:b],
+                     data["vel"][a:b], data["radius"][a:b], data["bonds"][c:d])
+
+    def __getitem__(self, index):
+        return self.frame(index)
+
+    def __iter__(self):
+        for index in range(self.n_frame):
+            yield self.frame(index)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def _animate(i):
     """a private function required by matplotlib for updating the diagram"""
-    info = "computing iteration = {}/{}".format(simu.current_iter_number, simu.tot_iter_number)
-    # print(info, ' '*10, end='\r') I disable it because it causes slowdown with idle
-    
-    for i in range(simu.update_plot_each):
-        simu.loop_function()
-        simu.current_iter_number += 1
-        simu.t += simu.dt
-
-    if simu.custom_title == False:
-        simu.title.set_text(info)
-        simu.msg.set_text(simu.msg_content)
-    else:
-        simu.title.set_text(simu.msg_content)
-    
-    for grain in simu.grain_list:
-        grain.patch.center = (grain.pos[0], grain.pos[1])
-        grain.patch.radius = grain.radius
-        grain.patch.set_facecolor(grain.color)
-        grain.patch.set_visible(grain.visible)
-        
-    for bond in simu.bond_list:
-        bond.patch.xy1 = (bond.gr1.pos[0], bond.gr1.pos[1])
-        bond.patch.xy2 = (bond.gr2.pos[0], bond.gr2.pos[1])
-
-    return simu.patch_list
+    simu.step(simu.update_plot_each)
+    return simu.update_plot()
 
 
 class lcm: 
@@ -281,65 +1913,249 @@ non wanted colliding pairs and increase the speed of collision detection."""
     point_min        = vec( 1000. , 1000.)
     point_max        = vec(-1000. ,-1000.)
     radius_max       = 0.
-    grain_list       = simu.grain_list
+    # True when the last pairs do not include the pairs of sleeping grains
+    partial          = False
 
     def update_domain():
         """this method update the bounding box of the grid"""
-        
-        lcm.radius_max = -1.
-        for gr in lcm.grain_list:
-            if (gr.radius > lcm.radius_max): lcm.radius_max = gr.radius
-
-        for gr in lcm.grain_list:
-            if (gr.pos[0]  < lcm.point_min[0]) : lcm.point_min[0] = gr.pos[0];
-            if (gr.pos[1]  < lcm.point_min[1]) : lcm.point_min[1] = gr.pos[1];
-            if (gr.pos[0]  > lcm.point_max[0]) : lcm.point_max[0] = gr.pos[0];
-            if (gr.pos[1]  > lcm.point_max[1]) : lcm.point_max[1] = gr.pos[1];
-            if (gr.radius > lcm.radius_max ) : lcm.radius_max = gr.radius;
+        grains = simu.grains
+        if grains.n == 0:
+            lcm.radius_max = -1.
+            return
+        # the reductions along the long axis of the N x 2 array are slow
+        x, y = grains.pos[:,0], grains.pos[:,1]
+        lcm.radius_max = grains.radius.max()
+        lcm.point_min  = vec(x.min(), y.min())
+        lcm.point_max  = vec(x.max(), y.max())
         lcm.domain_dimension = lcm.point_max - lcm.point_min
-        
 
-        
-    def compute_colliding_pair(expand_ratio=1.):
-        """this method returns a list of possible colliding pairs"""
+
+    def cells(expand_ratio=1.):
+        """updates the grid and returns the cell size alpha, the stride of 
+the cell numbers (the cell of column c and row r is c*stride + r) and the 
+cell of each grain. The grid has a ring of empty cells, so that neighbours
+always exist."""
+        grains = simu.grains
         lcm.update_domain()
         lcm.radius_max *= expand_ratio
-        
+
         alpha = 2*lcm.k*lcm.radius_max
         C = math.floor(lcm.domain_dimension[0]/alpha)+1
         R = math.floor(lcm.domain_dimension[1]/alpha)+1
+        lcm.grid_shape = (C, R)
+        simu.profile.gauge("lcm grid", lcm.grid_shape)
 
-        lcm.grid =  [[[] for i in range(R+2)] for j in range(C+2)]
-        
+        stride = R + 2
+        cr = np.floor((grains.pos - lcm.point_min)/alpha).astype(np.intp) + 1
+        return alpha, stride, cr[:,0]*stride + cr[:,1]
+
+
+    def bin(expand_ratio=1.):
+        """bins the grains in the cells of the grid with a counting sort. It
+returns alpha and stride (see cells), the grains sorted by cell, their 
+cells, and the first sorted grain and the number of grains of each cell."""
+        alpha, stride, cell = lcm.cells(expand_ratio)
+        C, R = lcm.grid_shape
+        order = np.argsort(cell, kind="stable")
+        sorted_cell = cell[order]
+        count = np.bincount(cell, minlength=(C+2)*stride)
+        start = np.cumsum(count) - count
+        return alpha, stride, order, sorted_cell, start, count
+
+
+    def segment_pairs(a, b):
+        """returns two int arrays (g, s) with the grains g[k] of simu.grains
+that may touch the segments a[s[k]] b[s[k]]. Each segment is sampled with
+a spacing of the cell size and the grains of the 3 x 3 cells around the 
+samples are given, so that the cost depends on the length of the segments
+and not on the number of grains. The grains are not sorted : the segments
+are binned in the cells instead, then each grain looks up its cell."""
+        grains = simu.grains
+        if grains.n == 0 or len(a) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        alpha, stride, cell = lcm.cells()
+        C, R = lcm.grid_shape
+        # a grain touching a segment is closer than alpha to a sample
+        length = np.sqrt(((b - a)**2).sum(axis=1))
+        m = np.floor(length/alpha).astype(np.intp) + 2
+        s = np.repeat(np.arange(len(a)), m)
+        u = (np.arange(m.sum()) - np.repeat(np.cumsum(m) - m, m))/np.repeat(m - 1, m)
+        sample = a[s] + u[:,None]*(b - a)[s]
+        cr = np.floor((sample - lcm.point_min)/alpha).astype(np.intp) + 1
+        near = (cr[:,0] >= 0) & (cr[:,0] <= C + 1) & (cr[:,1] >= 0) & (cr[:,1] <= R + 1)
+        s, cr = s[near], cr[near]
+        cells = []
+        for dc in (-1, 0, 1):
+            for dr in (-1, 0, 1):
+                c = np.clip(cr[:,0] + dc, 0, C + 1)*stride + np.clip(cr[:,1] + dr, 0, R + 1)
+                cells.append(c*len(a) + s)
+        # the segments sorted by cell, each (cell, segment) given once
+        c, s  = np.divmod(np.unique(np.concatenate(cells)), len(a))
+        count = np.bincount(c, minlength=(C + 2)*stride)
+        start = np.cumsum(count) - count
+        g = np.flatnonzero(count[cell])
+        g, k = _expand_pairs(g, start[cell[g]], count[cell[g]])
+        simu.profile.count("wall pairs", len(g))
+        return g, s[k]
+
+
+    @_timed("broad phase")
+    def compute_pair_index(expand_ratio=1.):
+        """this method returns two int arrays (i, j) with the indices in 
+simu.grains of the possible colliding pairs. The grains are binned in the 
+cells of the grid with a counting sort and each cell is paired with itself 
+and with half of its neighbours, so that each pair is given once. When most
+grains sleep (see sleep_control), the pairs of two sleeping grains are not 
+given."""
+        grains = simu.grains
+        if grains.n < 2:
+            lcm.grid_shape = (0, 0)
+            lcm.partial = False
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        alpha, stride, order, sorted_cell, start, count = lcm.bin(expand_ratio)
+
+        # with less than half of the grains awake, it is faster to search 
+        # the neighbours of the awake grains only
+        awake = ~grains.asleep
+        lcm.partial = 2*np.count_nonzero(awake) < grains.n
+        if lcm.partial:
+            return lcm._awake_pairs(order, sorted_cell, start, count, stride, awake)
+
+        # grains of the same cell : each grain with the next ones
+        p = np.arange(grains.n)
+        src   = [p]
+        first = [p + 1]
+        nb    = [start[sorted_cell] + count[sorted_cell] - p - 1]
+        # neighbour cells : (c-1,r+1), (c,r+1), (c+1,r+1) and (c+1,r)
+        for offset in (-stride+1, 1, stride+1, stride):
+            neighbour = sorted_cell + offset
+            src.append(p)
+            first.append(start[neighbour])
+            nb.append(count[neighbour])
+        i, j = _expand_pairs(np.concatenate(src), np.concatenate(first), np.concatenate(nb))
+        simu.profile.count("lcm pairs", len(i))
+        return order[i], order[j]
+
+
+    def _awake_pairs(order, sorted_cell, start, count, stride, awake):
+        """the pairs with at least one awake grain, the awake grains are 
+paired with all their neighbour cells so that the cost depends on the 
+number of awake grains only"""
+        rank = np.empty(len(order), dtype=np.intp)
+        rank[order] = np.arange(len(order))
+        p = rank[np.flatnonzero(awake)]
+        c = sorted_cell[p]
+        src, first, nb = [], [], []
+        for offset in (-stride-1, -stride, -stride+1, -1, 0, 1, stride-1, stride, stride+1):
+            neighbour = c + offset
+            src.append(p)
+            first.append(start[neighbour])
+            nb.append(count[neighbour])
+        i, j = _expand_pairs(np.concatenate(src), np.concatenate(first), np.concatenate(nb))
+        # a pair of awake grains is found from both sides, it is kept once
+        keep = (i < j) | ~awake[order[j]]
+        i, j = i[keep], j[keep]
+        simu.profile.count("lcm pairs", len(i))
+        return order[i], order[j]
+
+
+    def compute_colliding_pair(expand_ratio=1.):
+        """this method returns a list of possible colliding pairs"""
+        i, j = lcm.compute_pair_index(expand_ratio)
+        gl = simu.grain_list
+        return [(gl[a], gl[b]) for a, b in zip(i.tolist(), j.tolist())]
+
+
+class neighbour_list(_bound):
+    """a Verlet neighbour list built on top of the lcm. The pairs closer than
+expand_ratio times their contact distance are stored and reused until a 
+grain has moved more than half of the skin since the last build, the skin
+being the smallest extra distance (expand_ratio-1)*2*radius_min. The number
+of builds is recorded in n_build and the number of queries in n_call."""
+    def __init__(self, expand_ratio=1.1):
+        if expand_ratio <= 1.:
+            raise ValueError("expand_ratio must be greater than 1")
+        self.expand_ratio = expand_ratio
+        self.i = np.empty(0, dtype=np.intp)
+        self.j = np.empty(0, dtype=np.intp)
+        self.skin    = 0.
+        self.n_build = 0
+        self.n_call  = 0
+        self._ref_pos = None
+        self._version = None
+        self._partial = False
+        self._sim     = simu
+
+    def build(self):
+        """rebuild the list of pairs from the current positions"""
+        grains = self._sim.grains
+        with self._sim:
+            i, j = lcm.compute_pair_index(self.expand_ratio)
+        self._partial = lcm.partial
+        pos, radius = grains.pos, grains.radius
+        rel_pos = pos[j] - pos[i]
+        reach   = (radius[i] + radius[j])*self.expand_ratio
+        keep    = rel_pos[:,0]**2 + rel_pos[:,1]**2 < reach**2
+        self.i, self.j = i[keep], j[keep]
+        self.skin = 2.*(self.expand_ratio - 1.)*radius.min() if grains.n else 0.
+        self._ref_pos = pos.copy()
+        self._version = self._state()
+        self.n_build += 1
+        self._sim.profile.count("neighbour list builds")
+
+    def _state(self):
+        # when the pairs of two sleeping grains are not in the list, it must
+        # be rebuilt when grains wake up
+        if self._partial and self._sim.sleep is not None:
+            return self._sim.grains.version, self._sim.sleep.n_wake
+        return self._sim.grains.version, 0
+
+    def invalidate(self):
+        """force a rebuild at the next query"""
+        self._ref_pos = None
+
+    def needs_rebuild(self):
+        grains = self._sim.grains
+        if self._ref_pos is None or self._version != self._state():
+            return True
+        if grains.n == 0:
+            return False
+        disp = grains.pos - self._ref_pos
+        return (disp[:,0]**2 + disp[:,1]**2).max() > (self.skin/2.)**2
 
-        for gr in lcm.grain_list:
-            c = math.floor(C*(gr.pos[0] - lcm.point_min[0]) / (C*alpha)) + 1
-            r = math.floor(R*(gr.pos[1] - lcm.point_min[1]) / (R*alpha)) + 1
-            lcm.grid[c][r].append(gr)
+    @_timed("neighbour list")
+    def compute_pair_index(self):
+        """returns the (i, j) index arrays of the possible colliding pairs, 
+the list is rebuilt only when needed"""
+        self.n_call += 1
+        if self.needs_rebuild():
+            self.build()
+        return self.i, self.j
 
-        pair_list =[]
-        for c in range(1,C+1):
-            for r in range(1,R+1):
-                for dc in range(-1,2):
-                    for gr1 in lcm.grid[c][r]:
-                        for gr2 in lcm.grid[c+dc][r+1]:
-                            pair_list.append((gr1,gr2))
-                
-                for gr1 in lcm.grid[c][r]:
-                    for gr2 in lcm.grid[c+1][r]:
-                        pair_list.append((gr1,gr2))
-                
-                for i,gr1 in enumerate(lcm.grid[c][r]):
-                    for j in range(i+1, len(lcm.grid[c][r])):
-                        pair_list.append((gr1, lcm.grid[c][r][j]))
+    def rebuild_ratio(self):
+        """returns the fraction of the queries that triggered a rebuild"""
+        return self.n_build/self.n_call if self.n_call else 0.
 
-        return pair_list
 
+def _expand_pairs(src, first, count):
+    """returns the pairs (src[k], first[k] + m) for m in range(count[k])"""
+    keep  = count > 0
+    src, first, count = src[keep], first[keep], count[keep]
+    end   = np.cumsum(count)
+    shift = np.repeat(end - count, count)
+    i = np.repeat(src, count)
+    j = np.repeat(first, count) + np.arange(end[-1] if len(end) else 0) - shift
+    return i, j
 
 
 def run(*, tot_iter_number, update_plot_each, loop_fn, video_name = None):
-    """run the calculation here !"""
+    """run the calculation here ! If simu.profile is enabled, its summary is
+printed at the end, the time of the matplotlib rendering and of the video 
+encoding being in the "not instrumented" row."""
+    from matplotlib import animation
     simu.init(tot_iter_number, update_plot_each, loop_fn)
+    if simu.profile.enabled:
+        simu.profile.reset()
     n_frame = int(tot_iter_number/(update_plot_each)) - 1
     animate = animation.FuncAnimation(simu.fig, _animate, frames=n_frame, interval=2, blit=True, repeat=False )
     if video_name is not None:
@@ -354,4 +2170,6 @@ def run(*, tot_iter_number, update_plot_each, loop_fn, video_name = None):
         with open(r"C:\Users\abhir\Documents\Projects\dem_2d\myvideo.html", "w") as f:
             print(animate.to_html5_video(), file=f)
 
-        # plt.show()
\ No newline at end of file
+        # plt.show()
+    if simu.profile.enabled:
+        print(simu.profile.summary())
\ No newline at end of file
@@ -11,7 +11,15 @@ def return_full_path(filename: str = ".env") -> str:
 class Settings(BaseSettings):
     alpha_api_key: str
     db_name: str
+    db_pool_size: int = 8
+    db_timeout: float = 30.0
     model_directory: str
+    model_cache_size: int = 32
+    model_retention: int = 10
+    model_max_age_days: int | None = None
+    fit_workers: int = 2
+    fit_queue_size: int = 64
+    warm_up_tickers: list[str] = []
     
     class Config:
         env_file = return_full_path(".env")
@@ -1,5 +1,10 @@
+import queue
 import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager, nullcontext
 
+import numpy as np
 import pandas as pd
 import requests
 from config import settings
@@ -43,34 +48,382 @@ class AlphaVantageAPI:
         
         return df
 
+class ConnectionPool:
+    def __init__(self, db_name=settings.db_name, size=4, timeout=30.0):
+        self.db_name = db_name
+        self.size = size
+        self.timeout = timeout
+        
+        # Single write connection: SQLite allows one writer at a time, so
+        # writers queue on a lock instead of failing with "database is locked"
+        self._write_lock = threading.Lock()
+        self._writer = self._connect()
+        # Readers never block the writer (and vice versa) in WAL mode
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        
+        # Read connections shared through a queue
+        self._readers = queue.Queue()
+        for _ in range(size):
+            self._readers.put(self._connect(read_only=True))
+        self._connections = list(self._readers.queue) + [self._writer]
+    
+    def _connect(self, read_only=False):
+        
+        connection = sqlite3.connect(
+            self.db_name, timeout=self.timeout, check_same_thread=False
+            )
+        # Tune connection: WAL only needs a sync at checkpoints, keep temp
+        # tables in memory, 64 MB page cache and 256 MB memory map
+        connection.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA cache_size=-65536")
+        connection.execute("PRAGMA mmap_size=268435456")
+        if read_only:
+            connection.execute("PRAGMA query_only=ON")
+        
+        return connection
+    
+    @contextmanager
+    def reader(self):
+        
+        # Borrow a read connection / Handle exhausted pool
+        try:
+            connection = self._readers.get(timeout=self.timeout)
+        except queue.Empty:
+            raise Exception("Timed out waiting for a database connection")
+        try:
+            yield connection
+        finally:
+            self._readers.put(connection)
+    
+    @contextmanager
+    def writer(self):
+        
+        # Hold the write connection for one transaction
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+    
+    def close(self):
+        
+        # Close every connection, the WAL is checkpointed by the last one
+        with self._write_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+
 class SQLRepo:
-    def __init__(self, connection):
-        # Assign connection to SQL Repo
+    def __init__(self, connection=None, pool=None):
+        # Assign connection or connection pool to SQL Repo
         self.connection = connection
+        self.pool = pool
+        self.__registry_ready = False
+    
+    def _reader(self):
+        if self.pool is not None:
+            return self.pool.reader()
+        return nullcontext(self.connection)
+    
+    def _writer(self):
+        if self.pool is not None:
+            return self.pool.writer()
+        return self.__transaction()
+    
+    @contextmanager
+    def __transaction(self):
+        
+        # Commit on success / Roll back on error, as the pool writer does
+        try:
+            yield self.connection
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
         
     def insert_table(self, table_name, records, if_exists="fail"):
         
-        n_inserted = records.to_sql(
-            name=table_name,
-            con=self.connection,
-            if_exists=if_exists
-        )
+        with self._writer() as connection:
+            if if_exists == "replace":
+                return self.__replace_table(connection, table_name, records)
+            n_inserted = records.to_sql(
+                name=table_name,
+                con=connection,
+                if_exists=if_exists
+            )
         
         return n_inserted
     
     
-    def read_table(self, table_name, limit=None):
+    def __replace_table(self, connection, table_name, records):
         
-        # Create SQL Query
+        # pandas drops the old table in its own transaction, so load a
+        # staging table and swap it in one transaction: concurrent readers
+        # see either the old or the new table. The staging table is unique
+        # to this call, as other processes may replace the same table
+        staging = f"{table_name}__staging_{uuid.uuid4().hex}"
+        label = records.index.name or "index"
+        try:
+            n_inserted = records.to_sql(name=staging, con=connection, if_exists="fail")
+            
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            connection.execute(f'ALTER TABLE "{staging}" RENAME TO "{table_name}"')
+            # Index named as pandas does
+            connection.execute(f'DROP INDEX IF EXISTS "ix_{staging}_{label}"')
+            connection.execute(
+                f'CREATE INDEX "ix_{table_name}_{label}" ON "{table_name}" ("{label}")'
+                )
+            connection.commit()
+        except BaseException:
+            # Drop the staging table left by a failed load or swap
+            connection.rollback()
+            connection.execute(f'DROP TABLE IF EXISTS "{staging}"')
+            connection.commit()
+            raise
+        
+        return n_inserted
+    
+    
+    def upsert_table(self, table_name, records):
+        
+        label = records.index.name or "index"
+        columns = ", ".join(f'"{column}"' for column in [label, *records.columns])
+        placeholders = ", ".join("?" * (len(records.columns) + 1))
+        # Column types as pandas creates them
+        schema = ", ".join(
+            [f'"{label}" TIMESTAMP']
+            + [f'"{column}" {self.__sql_type(dtype)}' for column, dtype in records.dtypes.items()]
+            )
+        rows = [
+            (str(date), *values)
+            for date, values in zip(records.index, records.itertuples(index=False))
+            ]
+        
+        with self._writer() as connection:
+            # Lock for writing before reading the latest date, so no other
+            # writer (thread or process) can create the table or insert in
+            # between. A missing table has no latest date: all rows go in
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" ({schema})')
+            connection.execute(
+                f'CREATE INDEX IF NOT EXISTS "ix_{table_name}_{label}" ON "{table_name}" ("{label}")'
+                )
+            (latest,) = connection.execute(
+                f'SELECT MAX("{label}") FROM "{table_name}"'
+                ).fetchone()
+            
+            # Keep records from the latest stored date on, the latest day is
+            # rewritten as it may have been stored before the close
+            rows = [row for row in rows if latest is None or row[0] >= latest]
+            if rows:
+                connection.execute(
+                    f'DELETE FROM "{table_name}" WHERE "{label}" >= ?',
+                    (min(row[0] for row in rows),)
+                    )
+                connection.executemany(
+                    f'INSERT INTO "{table_name}" ({columns}) VALUES ({placeholders})', rows
+                    )
+        
+        return len(rows)
+    
+    
+    @staticmethod
+    def __sql_type(dtype):
+        if pd.api.types.is_float_dtype(dtype):
+            return "REAL"
+        if pd.api.types.is_integer_dtype(dtype):
+            return "INTEGER"
+        return "TEXT"
+    
+    
+    def latest_date(self, table_name):
+        
+        # Most recent date, from the end of the date index / None if no table
+        try:
+            with self._reader() as connection:
+                (latest,) = connection.execute(
+                    f'SELECT MAX("date") FROM "{table_name}"'
+                    ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        
+        return pd.Timestamp(latest) if latest is not None else None
+    
+    
+    def __select(self, table_name, columns, start, end, limit):
+        
+        # Filter on a date range, served by the date index
+        conditions, params = [], []
+        if start is not None:
+            conditions.append('"date" >= ?')
+            params.append(str(pd.Timestamp(start)))
+        if end is not None:
+            conditions.append('"date" <= ?')
+            params.append(str(pd.Timestamp(end)))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        # Project columns
+        if columns is None:
+            projection = "*"
+        else:
+            projection = ", ".join(f'"{column}"' for column in ["date", *columns])
+        sql = f'SELECT {projection} FROM "{table_name}"{where}'
+        
+        # Last rows of the range: walk the date index backwards then put
+        # them back in date order
         if limit:
-            sql = f"SELECT * FROM '{table_name}' LIMIT {limit}"
+            sql = f'SELECT * FROM ({sql} ORDER BY "date" DESC LIMIT {int(limit)}) ORDER BY "date"'
         else:
-            sql = f"SELECT * FROM '{table_name}'"
+            sql += ' ORDER BY "date"'
         
-        # Read query into df
-        df = pd.read_sql(
-            sql=sql, con=self.connection, parse_dates=["date"], index_col="date"
-            )
+        return sql, params
+    
+    
+    def read_table(
+        self, table_name, limit=None, start=None, end=None, columns=None, dtype=None
+    ):
+        
+        # Create SQL Query
+        sql, params = self.__select(table_name, columns, start, end, limit)
+        
+        # Read query into df, oldest row first
+        with self._reader() as connection:
+            df = pd.read_sql(
+                sql=sql, con=connection, params=params, parse_dates=["date"],
+                index_col="date", dtype=dtype
+                )
         
         return df
-        
\ No newline at end of file
+    
+    
+    def read_array(
+        self, table_name, columns, limit=None, start=None, end=None, dtype=float
+    ):
+        
+        # Create SQL Query
+        sql, params = self.__select(table_name, columns, start, end, limit)
+        with self._reader() as connection:
+            rows = connection.execute(sql, params).fetchall()
+        
+        # Fill a structured array column by column, without a dataframe:
+        # each field is a view of the array
+        fields = [("date", "datetime64[s]")] + [(column, dtype) for column in columns]
+        array = np.empty(len(rows), dtype=fields)
+        if rows:
+            dates, *values = zip(*rows)
+            array["date"] = np.array(dates, dtype="datetime64[s]")
+            for column, value in zip(columns, values):
+                array[column] = value
+        
+        return array
+    
+    
+    def create_model_registry(self):
+        
+        # One row per saved model / "latest per ticker" is one index lookup
+        with self._writer() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS model_registry (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ticker TEXT NOT NULL,
+                    p INTEGER,
+                    q INTEGER,
+                    n_obs INTEGER,
+                    data_start TIMESTAMP,
+                    data_end TIMESTAMP,
+                    aic REAL,
+                    bic REAL,
+                    created_at TIMESTAMP NOT NULL,
+                    path TEXT NOT NULL UNIQUE
+                )
+                """
+                )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_model_registry_ticker_created "
+                "ON model_registry (ticker, created_at, id)"
+                )
+        self.__registry_ready = True
+    
+    
+    def __ensure_model_registry(self):
+        if not self.__registry_ready:
+            self.create_model_registry()
+    
+    
+    def register_model(self, record):
+        
+        self.__ensure_model_registry()
+        
+        # Insert model record / Ignore a path already registered
+        columns = ", ".join(record)
+        placeholders = ", ".join("?" * len(record))
+        with self._writer() as connection:
+            cursor = connection.execute(
+                f"INSERT OR IGNORE INTO model_registry ({columns}) VALUES ({placeholders})",
+                list(record.values())
+                )
+        
+        return cursor.lastrowid
+    
+    
+    def registered_paths(self):
+        
+        self.__ensure_model_registry()
+        with self._reader() as connection:
+            rows = connection.execute("SELECT path FROM model_registry").fetchall()
+        
+        return {path for (path,) in rows}
+    
+    
+    def latest_model(self, ticker):
+        
+        self.__ensure_model_registry()
+        
+        # Most recent model of the ticker, exact match on the ticker
+        sql = (
+            "SELECT * FROM model_registry WHERE ticker = ? "
+            "ORDER BY created_at DESC, id DESC LIMIT 1"
+            )
+        with self._reader() as connection:
+            cursor = connection.execute(sql, (ticker,))
+            row = cursor.fetchone()
+        
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+    
+    
+    def prune_models(self, ticker, keep_last, max_age_days=None):
+        
+        self.__ensure_model_registry()
+        
+        # Models beyond the newest keep_last / Models older than max_age_days,
+        # the latest model of the ticker is always kept
+        sql = (
+            "SELECT id, path, created_at FROM model_registry WHERE ticker = ? "
+            "ORDER BY created_at DESC, id DESC"
+            )
+        keep_last = max(keep_last, 1)
+        if max_age_days is not None:
+            cutoff = (pd.Timestamp.now() - pd.Timedelta(days=max_age_days)).isoformat()
+        
+        with self._writer() as connection:
+            rows = connection.execute(sql, (ticker,)).fetchall()
+            pruned = [
+                (id, path) for rank, (id, path, created_at) in enumerate(rows)
+                if rank >= keep_last
+                or (rank > 0 and max_age_days is not None and created_at < cutoff)
+                ]
+            connection.executemany(
+                "DELETE FROM model_registry WHERE id = ?", [(id,) for id, path in pruned]
+                )
+        
+        # Paths of the removed records, the caller deletes the files
+        return [path for id, path in pruned]
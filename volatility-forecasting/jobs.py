@@ -0,0 +1,228 @@
+import multiprocessing as mp
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import pandas as pd
+from config import settings
+from data import ConnectionPool, SQLRepo
+from model import GARCHModel
+
+# Connection pool of a worker process
+_pool = None
+
+
+def _init_worker(db_name, timeout):
+    global _pool
+    # One pool per worker process, reused by its fits
+    _pool = ConnectionPool(db_name, size=1, timeout=timeout)
+
+
+def run_fit(ticker, use_new_data, n_obs, p, q):
+
+    # Build model on the worker connection pool
+    repo = SQLRepo(pool=_pool)
+    model = GARCHModel(ticker=ticker, repo=repo, use_new_data=use_new_data)
+
+    # Wrangle data / Fit model / Save model, timing each step
+    timings = {}
+    start = time.perf_counter()
+    model.wrangle_data(n_obs)
+    timings["wrangle"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.fit(p=p, q=q)
+    timings["fit"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    filename = model.dump()
+    timings["dump"] = time.perf_counter() - start
+
+    return {"aic": model.aic, "bic": model.bic, "filename": filename, "timings": timings}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    def __init__(
+        self, max_workers=2, max_queued=64, max_history=1000,
+        db_name=settings.db_name, timeout=settings.db_timeout
+    ):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_history = max_history
+
+        # Fits are CPU bound: run them in worker processes so they do not
+        # hold the GIL of the app serving /predict. Spawned, not forked, as
+        # the app has threads and open connections
+        self._processes = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=mp.get_context("spawn"),
+            initializer=_init_worker, initargs=(db_name, timeout)
+        )
+        # One thread per running job, a job is running once its thread
+        # takes it, so at most max_workers fits run at a time
+        self._threads = ThreadPoolExecutor(max_workers=max_workers)
+
+        # job id -> job, oldest first / request -> id of its queued or running job
+        self._jobs = OrderedDict()
+        self._in_flight = {}
+        # job id -> future of its thread, resolved with the finished job
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+
+
+    def submit(self, ticker, use_new_data, n_obs, p, q, block=False):
+
+        job, queued, future = self.__submit((ticker, use_new_data, n_obs, p, q), block)
+        return job, queued
+
+
+    def __submit(self, key, block):
+
+        # Returns the job, whether it was queued and the future of its thread,
+        # read under the lock as a finished job may be trimmed at any time
+        ticker, use_new_data, n_obs, p, q = key
+        with self._lock:
+            while True:
+                # Identical fit already queued or running: share its job
+                job_id = self._in_flight.get(key)
+                if job_id is not None:
+                    return dict(self._jobs[job_id]), False, self._futures[job_id]
+
+                # Bound the number of queued and running jobs / Wait for room
+                if len(self._in_flight) < self.max_queued:
+                    break
+                if not block:
+                    raise QueueFull(f"Too many fit jobs in progress ({self.max_queued}), retry later")
+                self._room.wait()
+
+            job = {
+                "id": uuid.uuid4().hex,
+                "status": "queued",
+                "ticker": ticker,
+                "use_new_data": use_new_data,
+                "n_obs": n_obs,
+                "p": p,
+                "q": q,
+                "submitted_at": pd.Timestamp.now().isoformat(),
+                "started_at": None,
+                "finished_at": None,
+                "queue_seconds": None,
+                "run_seconds": None,
+                "timings": {},
+                "aic": None,
+                "bic": None,
+                "filename": None,
+                "message": "Fit job queued",
+            }
+            self._jobs[job["id"]] = job
+            self._in_flight[key] = job["id"]
+            # Durations from a monotonic clock, the ISO times are for display
+            future = self._threads.submit(self.__run, key, job, time.monotonic())
+            self._futures[job["id"]] = future
+            self.__trim()
+
+        return dict(job), True, future
+
+
+    def run_batch(self, requests):
+
+        # Submit fits while the queue has room / Yield (index, job) of each
+        # request as its job finishes
+        requests = list(requests)
+        waiting = {}
+        n_submitted = 0
+        while n_submitted < len(requests) or waiting:
+            while n_submitted < len(requests):
+                # Only block on a queue full of other jobs
+                request = requests[n_submitted]
+                key = tuple(request[name] for name in ("ticker", "use_new_data", "n_obs", "p", "q"))
+                try:
+                    job, queued, future = self.__submit(key, block=not waiting)
+                except QueueFull:
+                    break
+                # Identical requests of the batch share one job
+                waiting.setdefault(future, []).append(n_submitted)
+                n_submitted += 1
+
+            done, _ = wait(list(waiting), return_when=FIRST_COMPLETED)
+            for future in done:
+                job = future.result()
+                for index in waiting.pop(future):
+                    yield index, job
+
+
+    def __run(self, key, job, submitted):
+
+        # Mark job as running
+        started = time.monotonic()
+        with self._lock:
+            job["status"] = "running"
+            job["started_at"] = pd.Timestamp.now().isoformat()
+            job["queue_seconds"] = started - submitted
+
+        # Fit in a worker process / Record error of failed fits
+        try:
+            result = self._processes.submit(run_fit, *key).result()
+            update = {
+                "status": "succeeded",
+                "message": (
+                    f"Trained and saved '{result['filename']}' - "
+                    f"Metrics: AIC {result['aic']}, BIC {result['bic']}"
+                ),
+                **result,
+            }
+        except Exception as x:
+            update = {"status": "failed", "message": str(x)}
+
+        with self._lock:
+            job.update(update)
+            job["finished_at"] = pd.Timestamp.now().isoformat()
+            job["run_seconds"] = time.monotonic() - started
+            self._in_flight.pop(key, None)
+            self._room.notify_all()
+            return dict(job)
+
+
+    def __trim(self):
+
+        # Forget the oldest finished jobs beyond max_history
+        in_flight = set(self._in_flight.values())
+        excess = len(self._jobs) - self.max_history
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if job_id not in in_flight:
+                del self._jobs[job_id]
+                self._futures.pop(job_id, None)
+                excess -= 1
+
+
+    def get(self, job_id):
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+
+    def stats(self):
+
+        with self._lock:
+            statuses = [job["status"] for job in self._jobs.values()]
+        return {
+            "max_workers": self.max_workers,
+            "max_queued": self.max_queued,
+            **{status: statuses.count(status) for status in ("queued", "running", "succeeded", "failed")},
+        }
+
+
+    def shutdown(self):
+
+        # Drop queued jobs / Wait for running fits
+        self._threads.shutdown(wait=False, cancel_futures=True)
+        self._processes.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,189 @@
+"""Local load test for the volatility API.
+
+db mode compares the old database access (a new connection per request on
+the default rollback journal) with the pooled WAL access of ConnectionPool,
+each on its own copy of the database. Concurrent workers run the query of
+/fit and a fraction of them upsert the latest days of the table, as /fit
+does with use_new_data. Reads and writes are reported separately.
+
+http mode sends concurrent /predict and /fit requests to a running app.
+
+    python load_test.py db --concurrency 16 --requests 400
+    python load_test.py http --url http://localhost:8008 --ticker IBM --concurrency 16
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from config import settings
+from data import ConnectionPool, SQLRepo
+
+
+def run_load(task, n_requests, concurrency, kind=lambda i: "all"):
+
+    # Time each request / Count failures
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            ok = task(i) is not False
+        except Exception:
+            ok = False
+        return kind(i), time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, range(n_requests)))
+    elapsed = time.perf_counter() - start
+
+    # Statistics per kind of request, then of all requests
+    kinds = sorted({k for k, latency, ok in results})
+    if len(kinds) > 1:
+        kinds.append(None)
+    summary = {}
+    for name in kinds:
+        selected = [(latency, ok) for k, latency, ok in results if name is None or k == name]
+        # Throughput of the successful requests, failures are often fast
+        latencies = np.array([latency for latency, ok in selected]) * 1000
+        errors = sum(not ok for latency, ok in selected)
+        summary[name or "all"] = {
+            "requests": len(selected),
+            "errors": errors,
+            "throughput": (len(selected) - errors) / elapsed,
+            "p50": np.percentile(latencies, 50),
+            "p99": np.percentile(latencies, 99),
+        }
+    return summary
+
+
+def print_results(rows):
+    print(f"{'':<18}{'requests':>10}{'errors':>8}{'ok req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, summary in rows:
+        for kind, r in summary.items():
+            print(
+                f"{name + ' ' + kind:<18}{r['requests']:>10}{r['errors']:>8}{r['throughput']:>10.1f}"
+                f"{r['p50']:>10.1f}{r['p99']:>10.1f}"
+            )
+
+
+def copy_database(db_name, path, journal_mode):
+
+    # Online backup: includes the rows still in the -wal file of a live
+    # database, then set the journal mode, which is stored in the file
+    source, target = sqlite3.connect(db_name), sqlite3.connect(path)
+    try:
+        source.backup(target)
+        (mode,) = target.execute(f"PRAGMA journal_mode={journal_mode}").fetchone()
+        if mode.lower() != journal_mode.lower():
+            raise Exception(f"Could not set journal_mode={journal_mode} on '{path}'")
+    finally:
+        source.close()
+        target.close()
+    return path
+
+
+def db_load_test(args):
+
+    # Latest days upserted by the write requests, as a compact download
+    connection = sqlite3.connect(args.db_name)
+    records = SQLRepo(connection=connection).read_table(args.ticker, limit=100)
+    connection.close()
+
+    def is_write(i):
+        return random.Random(i).random() < args.write_ratio
+
+    def kind(i):
+        return "write" if is_write(i) else "read"
+
+    def request(repo, i):
+        if is_write(i):
+            repo.upsert_table(args.ticker, records)
+        else:
+            repo.read_table(args.ticker, limit=args.n_obs + 1, columns=["close"])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rows = []
+
+        # Old access: one connection per request, default rollback journal
+        path = copy_database(args.db_name, os.path.join(tmp, "unpooled.sqlite"), "DELETE")
+        def unpooled(i):
+            connection = sqlite3.connect(path, check_same_thread=False)
+            try:
+                request(SQLRepo(connection=connection), i)
+            finally:
+                connection.close()
+        rows.append(("unpooled", run_load(unpooled, args.requests, args.concurrency, kind)))
+
+        # Pooled WAL access
+        path = copy_database(args.db_name, os.path.join(tmp, "pooled.sqlite"), "WAL")
+        pool = ConnectionPool(path, size=args.pool_size)
+        repo = SQLRepo(pool=pool)
+        try:
+            rows.append(("pooled", run_load(lambda i: request(repo, i), args.requests, args.concurrency, kind)))
+        finally:
+            pool.close()
+
+    print(
+        f"{args.requests} requests on '{args.ticker}', {args.concurrency} concurrent, "
+        f"{args.write_ratio:.0%} writes"
+    )
+    print_results(rows)
+
+
+def http_load_test(args):
+    import httpx
+
+    client = httpx.Client(
+        base_url=args.url, timeout=60,
+        limits=httpx.Limits(max_connections=args.concurrency)
+    )
+
+    def is_fit(i):
+        return random.Random(i).random() < args.fit_ratio
+
+    def kind(i):
+        return "fit" if is_fit(i) else "predict"
+
+    def request(i):
+        if is_fit(i):
+            json = {"ticker": args.ticker, "use_new_data": False, "n_obs": args.n_obs, "p": 1, "q": 1}
+            response = client.post("/fit", json=json)
+        else:
+            response = client.post("/predict", json={"ticker": args.ticker, "n_days": 5})
+        return response.status_code == 200 and response.json()["success"]
+
+    with client:
+        # Warm up the app before measuring
+        request(0)
+        result = run_load(request, args.requests, args.concurrency, kind)
+
+    print(
+        f"{args.requests} requests to {args.url} on '{args.ticker}', {args.concurrency} concurrent, "
+        f"{args.fit_ratio:.0%} /fit"
+    )
+    print_results([("http", result)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("mode", choices=["db", "http"])
+    parser.add_argument("--ticker", default="IBM")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--n-obs", type=int, default=2000)
+    parser.add_argument("--db-name", default=settings.db_name)
+    parser.add_argument("--pool-size", type=int, default=settings.db_pool_size)
+    parser.add_argument("--write-ratio", type=float, default=0.05, help="share of upserts (db mode)")
+    parser.add_argument("--url", default="http://localhost:8008")
+    parser.add_argument("--fit-ratio", type=float, default=0.2, help="share of /fit requests (http mode)")
+    args = parser.parse_args()
+
+    if args.mode == "db":
+        db_load_test(args)
+    else:
+        http_load_test(args)
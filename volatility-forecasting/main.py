@@ -1,9 +1,12 @@
-import sqlite3
+import json
+from contextlib import asynccontextmanager
 
 from config import settings
-from data import SQLRepo
-from fastapi import FastAPI
-from model import GARCHModel
+from data import ConnectionPool, SQLRepo
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from jobs import JobQueue
+from model import GARCHModel, ModelCache, register_existing_models
 from pydantic import BaseModel
 
 
@@ -18,6 +21,22 @@ class FitIn(BaseModel):
 class FitOut(FitIn):
     success: bool
     message: str
+    job_id: str | None = None
+
+
+class JobOut(FitIn):
+    id: str
+    status: str
+    submitted_at: str
+    started_at: str | None
+    finished_at: str | None
+    queue_seconds: float | None
+    run_seconds: float | None
+    timings: dict
+    aic: float | None
+    bic: float | None
+    filename: str | None
+    message: str
     
 
 class PredictIn(BaseModel):
@@ -31,20 +50,84 @@ class PredictOut(PredictIn):
     message: str
 
 
+class FitBatchIn(BaseModel):
+    fits: list[FitIn]
+
+
+class PredictBatchIn(BaseModel):
+    predictions: list[PredictIn]
+
+
 def build_model(ticker, use_new_data):
     
-    # Create sqlite connection
-    connection = sqlite3.connect(settings.db_name, check_same_thread=False)
-    # Instantiate SQLRepo
-    repo = SQLRepo(connection=connection)
-    # Instantiate model
-    model = GARCHModel(ticker=ticker, repo=repo, use_new_data=use_new_data)
+    # Instantiate SQLRepo on the shared connection pool
+    repo = SQLRepo(pool=app.state.pool)
+    # Instantiate model with the shared model cache
+    model = GARCHModel(
+        ticker=ticker, repo=repo, use_new_data=use_new_data, cache=app.state.model_cache
+    )
     
     return model
 
 
+def predict(request):
+    
+    # Create dict from request
+    response = request.dict()
+    
+    try:
+        # Build model
+        model = build_model(ticker = request.ticker, use_new_data=False)
+        # Load model
+        model.load()
+        # Generate prediction
+        prediction = model.predict_volatility(horizon=request.n_days)
+        
+         # Create response
+        response["success"] = True
+        response["forecast"] = prediction
+        response["message"] = "Model loaded and prediction generated successfully"
+        
+    except Exception as x:
+        response["success"] = False
+        response["forecast"] = {}
+        response["message"] = str(x)
+    
+    return response
+
+
+def stream_lines(results):
+    # One JSON document per line, sent as soon as it is ready
+    for result in results:
+        yield json.dumps(result) + "\n"
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Open the connection pool once for the lifetime of the app
+    app.state.pool = ConnectionPool(
+        settings.db_name, size=settings.db_pool_size, timeout=settings.db_timeout
+    )
+    # Create the model registry / Register model files saved before it
+    repo = SQLRepo(pool=app.state.pool)
+    repo.create_model_registry()
+    register_existing_models(repo, settings.model_directory)
+    # Load the models of the configured tickers before the first /predict
+    app.state.model_cache = ModelCache(repo, max_size=settings.model_cache_size)
+    app.state.model_cache.warm_up(settings.warm_up_tickers)
+    # Fit jobs run in a pool of worker processes
+    app.state.jobs = JobQueue(
+        max_workers=settings.fit_workers, max_queued=settings.fit_queue_size,
+        db_name=settings.db_name, timeout=settings.db_timeout
+    )
+    yield
+    # Wait for running fits / Close the pooled connections on shutdown
+    app.state.jobs.shutdown()
+    app.state.pool.close()
+
+
 # Instantiate FastAPI object
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 @app.post("/fit", status_code=200, response_model=FitOut)
 def fit_model(request: FitIn):
@@ -53,22 +136,16 @@ def fit_model(request: FitIn):
     
     # Handle exceptions
     try:
-        # Build model
-        model = build_model(ticker = request.ticker, use_new_data=request.use_new_data)
-        # Wrangle data
-        model.wrangle_data(request.n_obs)
-        # Fit model
-        model.fit(p=request.p, q=request.p)
-        # Store AIC and BIC metrics
-        aic = model.aic
-        bic = model.bic
-        
-        # Save model
-        filename = model.dump()
+        # Queue fit job / Share the job of an identical fit in progress
+        job, queued = app.state.jobs.submit(**request.dict())
         
         # Create response
         response["success"] = True
-        response["message"] = f"Trained and saved '{filename}' - Metrics: AIC {aic}, BIC {bic}"
+        response["job_id"] = job["id"]
+        if queued:
+            response["message"] = f"Fit job '{job['id']}' queued - Poll /jobs/{job['id']} for its status"
+        else:
+            response["message"] = f"Identical fit job '{job['id']}' already {job['status']} - Poll /jobs/{job['id']} for its status"
     
     except Exception as x:
         # create null response
@@ -76,28 +153,51 @@ def fit_model(request: FitIn):
          response["message"] = str(x)
     return response
 
+
+@app.get("/jobs/{job_id}", status_code=200, response_model=JobOut)
+def get_job(job_id: str):
+    # Status, timings and metrics of a fit job
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No fit job '{job_id}'")
+    return job
+
+
+@app.get("/jobs", status_code=200)
+def get_job_stats():
+    # Number of jobs per status
+    return app.state.jobs.stats()
+
+
 @app.post("/predict", status_code=200, response_model=PredictOut)
 def get_prediction(request: PredictIn):
+    return predict(request)
+
+
+@app.post("/fit/batch", status_code=200)
+def fit_batch(request: FitBatchIn):
     
-    # Create dict from request
-    response = request.dict()
+    # Fit in parallel in the job queue / Stream each result as its job finishes
+    def results():
+        fits = [fit.dict() for fit in request.fits]
+        for index, job in app.state.jobs.run_batch(fits):
+            yield {"index": index, "success": job["status"] == "succeeded", "job_id": job["id"], **job}
     
-    try:
-        # Build model
-        model = build_model(ticker = request.ticker, use_new_data=False)
-        # Load model
-        model.load()
-        # Generate prediction
-        prediction = model.predict_volatility(horizon=request.n_days)
-        
-         # Create response
-        response["success"] = True
-        response["forecast"] = prediction
-        response["message"] = "Model loaded and prediction generated successfully"
-        
-    except Exception as x:
-        response["success"] = False
-        response["forecast"] = {}
-        response["message"] = str(x)
+    return StreamingResponse(stream_lines(results()), media_type="application/x-ndjson")
+
+
+@app.post("/predict/batch", status_code=200)
+def predict_batch(request: PredictBatchIn):
+    
+    # Predict with the shared pool and model cache / Stream each forecast
+    def results():
+        for index, prediction in enumerate(request.predictions):
+            yield {"index": index, **predict(prediction)}
     
-    return response
\ No newline at end of file
+    return StreamingResponse(stream_lines(results()), media_type="application/x-ndjson")
+
+
+@app.get("/cache", status_code=200)
+def get_cache_stats():
+    # Hit / miss counters of the model cache
+    return app.state.model_cache.stats()
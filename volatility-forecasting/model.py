@@ -1,4 +1,6 @@
 import os
+import threading
+from collections import OrderedDict
 from glob import glob
 
 import joblib
@@ -7,32 +9,151 @@ from arch import arch_model
 from config import settings
 from data import AlphaVantageAPI, SQLRepo
 
+
+def model_filename(timestamp, ticker):
+    # ISO format timestamp without colons
+    return f"{timestamp.isoformat().replace(':', '_')}_{ticker}.pkl"
+
+
+def register_existing_models(repo, model_directory=settings.model_directory):
+    
+    # Register model files saved before the registry / Skip known files
+    registered = repo.registered_paths()
+    n_registered = 0
+    for path in sorted(glob(os.path.join(model_directory, "*.pkl"))):
+        if path in registered:
+            continue
+        # Parse "{timestamp}_{ticker}.pkl", the timestamp has two "_"
+        try:
+            date, minute, second, ticker = os.path.basename(path)[:-4].split("_", 3)
+            created_at = pd.Timestamp(f"{date}:{minute}:{second}")
+        except ValueError:
+            continue
+        repo.register_model(
+            {"ticker": ticker, "created_at": created_at.isoformat(), "path": path}
+            )
+        n_registered += 1
+    
+    return n_registered
+
+
+class ModelCache:
+    def __init__(self, repo, max_size=32):
+        self.repo = repo
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # ticker -> (registry id, model), least recent first
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+    
+    
+    def get(self, ticker):
+        
+        # Latest registered model: one index lookup / Handle errors
+        record = self.repo.latest_model(ticker)
+        if record is None:
+            raise Exception(f"No model trained for '{ticker}'")
+        
+        with self._lock:
+            entry = self._models.get(ticker)
+            if entry is not None and entry[0] == record["id"]:
+                self._models.move_to_end(ticker)
+                self.hits += 1
+                return entry[1]
+        
+        # New model registered since cached / Not cached yet
+        model = joblib.load(record["path"])
+        
+        # Store as most recent / Evict least recently used models
+        with self._lock:
+            self.misses += 1
+            self._models[ticker] = (record["id"], model)
+            self._models.move_to_end(ticker)
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+        
+        return model
+    
+    
+    def invalidate(self, ticker=None):
+        
+        with self._lock:
+            if ticker is None:
+                self._models.clear()
+            else:
+                self._models.pop(ticker, None)
+    
+    
+    def warm_up(self, tickers):
+        
+        # Load models of given tickers / Skip tickers without a model
+        loaded = []
+        for ticker in tickers:
+            try:
+                self.get(ticker)
+                loaded.append(ticker)
+            except Exception:
+                pass
+        
+        return loaded
+    
+    
+    def stats(self):
+        
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._models),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "tickers": list(self._models),
+            }
+
+
 class GARCHModel:
     
     def __init__(
-        self, ticker, repo, use_new_data, model_directory=settings.model_directory
+        self, ticker, repo, use_new_data, model_directory=settings.model_directory,
+        cache=None, api=None
     ):
     
         self.ticker = ticker
         self.repo = repo
         self.use_new_data = use_new_data
         self.model_directory = model_directory
+        self.cache = cache
+        self.api = api if api is not None else AlphaVantageAPI()
     
     
     
+    def update_data(self):
+        
+        # Compact output holds the last 100 days: enough when the stored
+        # data is more recent, else download the full history
+        latest = self.repo.latest_date(self.ticker)
+        if latest is not None and len(pd.bdate_range(latest, pd.Timestamp.now())) < 100:
+            new_data = self.api.get_daily(ticker=self.ticker, output_size="compact")
+            # Gap between stored and compact data
+            if new_data.index.min() > latest:
+                new_data = self.api.get_daily(ticker=self.ticker)
+        else:
+            new_data = self.api.get_daily(ticker=self.ticker)
+        
+        # Insert rows from the latest stored date on
+        return self.repo.upsert_table(table_name=self.ticker, records=new_data)
+    
+    
     def wrangle_data(self, n_obs):
         
         # If specified, insert new data
         if self.use_new_data:
-            api = AlphaVantageAPI()
-            ticker = self.ticker
-            new_data = api.get_daily(ticker=ticker)
-            self.repo.insert_table(
-                table_name=self.ticker, records=new_data, if_exists="replace"
-                )
+            self.update_data()
         
         # Query data from SQL database
-        df = self.repo.read_table(table_name=self.ticker, limit=n_obs+1)
+        df = self.repo.read_table(table_name=self.ticker, limit=n_obs+1, columns=["close"])
         
         #Clean data
         df.sort_index(ascending=True, inplace=True)
@@ -44,6 +165,8 @@ class GARCHModel:
         
         # Instantiate model and train
         self.model = arch_model(self.data, p=p, q=q, rescale=False).fit(disp=0)
+        self.p = p
+        self.q = q
         
         # Define AIC and BIC metrics
         self.aic = self.model.aic
@@ -79,26 +202,76 @@ class GARCHModel:
     def dump(self):
         
         # Create ISO format timestamp
-        timestamp = pd.Timestamp.now().isoformat().replace(":", "_")
+        timestamp = pd.Timestamp.now()
 
         # Create filepath for model
         filepath = os.path.join(
-            self.model_directory, rf"{timestamp}_{self.ticker}.pkl"
+            self.model_directory, model_filename(timestamp, self.ticker)
         )
-        #save model
-        joblib.dump(self.model, filepath)
+        # Save model to a temporary file then rename it, so a registered
+        # path is always a complete file
+        tmp_filepath = f"{filepath}.tmp"
+        joblib.dump(self.model, tmp_filepath)
+        os.replace(tmp_filepath, filepath)
+        
+        # Register model / Remove the file if it cannot be registered
+        record = {
+            "ticker": self.ticker,
+            "p": self.p,
+            "q": self.q,
+            "n_obs": len(self.data),
+            "data_start": self.data.index.min().isoformat(),
+            "data_end": self.data.index.max().isoformat(),
+            "aic": self.aic,
+            "bic": self.bic,
+            "created_at": timestamp.isoformat(),
+            "path": filepath,
+        }
+        try:
+            self.repo.register_model(record)
+        except Exception:
+            os.remove(filepath)
+            raise
+        
+        # Apply retention policy to older models of this ticker
+        self.prune()
+        
+        # Drop cached model of this ticker
+        if self.cache is not None:
+            self.cache.invalidate(self.ticker)
         
         return filepath
     
+    
+    def prune(self, keep_last=None, max_age_days=None):
+        
+        # Default to configured retention policy
+        if keep_last is None:
+            keep_last = settings.model_retention
+        if max_age_days is None:
+            max_age_days = settings.model_max_age_days
+        
+        # Unregister old models then delete their files
+        paths = self.repo.prune_models(self.ticker, keep_last, max_age_days)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        
+        return paths
+    
+    
     def load(self):
-        # Create pattern for glob search
-        pattern = os.path.join(self.model_directory, f"*{self.ticker}.pkl")
+        # Load model from cache
+        if self.cache is not None:
+            self.model = self.cache.get(self.ticker)
+            return
         
-        # Use glob to get most recent model / Handle errors
-        try:
-            model_path = sorted(glob(pattern))[-1]
-        except IndexError:
-            raise Exception(f"No model trained for '{self.ticker}")
+        # Get most recent model from registry / Handle errors
+        record = self.repo.latest_model(self.ticker)
+        if record is None:
+            raise Exception(f"No model trained for '{self.ticker}'")
         
         # Load model
-        self.model = joblib.load(model_path)
\ No newline at end of file
+        self.model = joblib.load(record["path"])
\ No newline at end of file
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Settings are read on import: the tests need no .env nor API key
+os.environ.setdefault("ALPHA_API_KEY", "test")
+os.environ.setdefault("DB_NAME", "stocks.sqlite")
+os.environ.setdefault("MODEL_DIRECTORY", "models")
+
+# Import the app modules from the project directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
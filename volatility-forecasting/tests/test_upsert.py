@@ -0,0 +1,116 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+from data import SQLRepo
+from model import GARCHModel
+
+
+class LocalAPI:
+    # Stand-in for AlphaVantageAPI: serves a fixed history, newest first
+    def __init__(self, history, compact_size=100):
+        self.history = history
+        self.compact_size = compact_size
+        self.calls = []
+    
+    def get_daily(self, ticker, output_size="full"):
+        self.calls.append(output_size)
+        df = self.history.sort_index(ascending=False)
+        if output_size == "compact":
+            return df.head(self.compact_size)
+        return df
+
+
+def make_history(n_days, end=None):
+    # Daily OHLCV up to today, as returned by get_daily
+    dates = pd.bdate_range(end=end or pd.Timestamp.now().normalize(), periods=n_days)
+    values = np.arange(n_days, dtype=float) + 100
+    df = pd.DataFrame(
+        {column: values for column in ("open", "high", "low", "close", "volume")},
+        index=pd.DatetimeIndex(dates, name="date")
+    )
+    return df.sort_index(ascending=False)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    connection = sqlite3.connect(tmp_path / "stocks.sqlite")
+    yield SQLRepo(connection=connection)
+    connection.close()
+
+
+def count_rows(repo, table_name):
+    return repo.connection.execute(
+        f'SELECT COUNT(*), COUNT(DISTINCT "date") FROM "{table_name}"'
+    ).fetchone()
+
+
+def index_names(repo, table_name):
+    rows = repo.connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (table_name,)
+    ).fetchall()
+    return [name for (name,) in rows]
+
+
+def test_missing_table_gets_full_history_and_index(repo):
+    api = LocalAPI(make_history(300))
+    model = GARCHModel("NEW", repo, use_new_data=True, api=api)
+    
+    assert model.update_data() == 300
+    assert api.calls == ["full"]
+    assert count_rows(repo, "NEW") == (300, 300)
+    assert index_names(repo, "NEW") == ["ix_NEW_date"]
+
+
+def test_recent_table_gets_compact_fetch_from_latest_date(repo):
+    history = make_history(300)
+    repo.insert_table("IBM", history.iloc[5:], if_exists="replace")
+    api = LocalAPI(history)
+    model = GARCHModel("IBM", repo, use_new_data=True, api=api)
+    
+    # Latest stored day rewritten + 5 new days
+    assert model.update_data() == 6
+    assert api.calls == ["compact"]
+    assert count_rows(repo, "IBM") == (300, 300)
+    assert repo.latest_date("IBM") == history.index.max()
+
+
+def test_compact_window_after_stored_data_falls_back_to_full(repo):
+    history = make_history(300)
+    repo.insert_table("IBM", history.iloc[70:], if_exists="replace")
+    # Recent enough for compact, but the compact window leaves a gap
+    api = LocalAPI(history, compact_size=50)
+    model = GARCHModel("IBM", repo, use_new_data=True, api=api)
+    
+    assert model.update_data() == 71
+    assert api.calls == ["compact", "full"]
+    assert count_rows(repo, "IBM") == (300, 300)
+
+
+def test_second_upsert_rewrites_only_last_day(repo):
+    history = make_history(300)
+    assert repo.upsert_table("IBM", history) == 300
+    
+    # Same data with a revised close on the last day
+    revised = history.copy()
+    revised.loc[revised.index.max(), "close"] = 1.0
+    assert repo.upsert_table("IBM", revised) == 1
+    
+    assert count_rows(repo, "IBM") == (300, 300)
+    df = repo.read_table("IBM")
+    assert df["close"].iloc[-1] == 1.0
+    assert df["close"].iloc[:-1].equals(history["close"].sort_index().iloc[:-1])
+
+
+def test_date_index_kept_after_upserts(repo):
+    history = make_history(300)
+    repo.insert_table("IBM", history.iloc[10:], if_exists="replace")
+    repo.upsert_table("IBM", history.iloc[5:])
+    repo.upsert_table("IBM", history)
+    
+    assert index_names(repo, "IBM") == ["ix_IBM_date"]
+    plan = repo.connection.execute(
+        'EXPLAIN QUERY PLAN SELECT * FROM "IBM" WHERE "date" >= ?', ("2020-01-01",)
+    ).fetchall()
+    assert "ix_IBM_date" in plan[0][-1]